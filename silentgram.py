@@ -12,45 +12,122 @@ Created: 7 Feb 2026
 Last updated: 7 Feb 2026
 '''
 
+__version__ = '1.7'
+
+import time
+MODULE_LOAD_STARTED = time.perf_counter() # Start of the 'imports' phase in --profile-startup
+
 import os
 import sys
+import argparse
 import shutil
 import json
 import asyncio
+import binascii
+import hashlib
+import hmac
+import zlib
+import sqlite3
+import subprocess
+import threading
 import html
-import gnupg
+import re
+import tempfile
+import contextlib
+import functools
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
 from datetime import datetime
-from telethon import TelegramClient, events
+# Telethon and python-gnupg are imported where they are first needed (TelegramTransport,
+# GnuPGBackend): together they are ~250 ms of start-up, and replay mode or the pgpy
+# backend never needs one of them.
 from prompt_toolkit import PromptSession, print_formatted_text, HTML
+from prompt_toolkit.formatted_text import to_formatted_text
 from prompt_toolkit.patch_stdout import patch_stdout
-from prompt_toolkit.styles import Style
+from prompt_toolkit.application import run_in_terminal
+from prompt_toolkit.application.current import create_app_session, get_app_or_none, get_app_session
+from prompt_toolkit.renderer import print_formatted_text as render_fragments
+from prompt_toolkit.output import DummyOutput
+from prompt_toolkit.styles import Style, default_ui_style, merge_styles
 
 # --- Configuration (Absolute Paths) ---
 SCRIPT_DIR = os.path.dirname(os.path.abspath(__file__))
 SESSION_FILE = os.path.join(SCRIPT_DIR, 'silentgram_session')
 KEYS_FILE = os.path.join(SCRIPT_DIR, 'keys.json')
 API_CONFIG_FILE = os.path.join(SCRIPT_DIR, 'api_config.json') # <--- New config file
+CACHE_FILE = os.path.join(SCRIPT_DIR, 'silentgram_cache.db') # Encrypted decrypted-message cache
+SEARCH_INDEX_FILE = os.path.join(SCRIPT_DIR, 'silentgram_search.db') # Encrypted /search index
+ENTITY_CACHE_FILE = os.path.join(SCRIPT_DIR, 'silentgram_entities.json') # Resolved usernames, skips get_entity on start
 GPG_HOME = os.path.expanduser('/tmp/sg_gpg_final') 
+KEYRING_MANIFEST = 'sg_manifest.json' # Lives inside GPG_HOME, wiped with it
+DEFAULT_AGENT_CACHE_TTL = 600   # seconds the agent keeps the preset passphrase (0 = until exit)
+DEFAULT_CACHE_MAX_ENTRIES = 5000 # Decrypted messages kept in the local cache (LRU)
+SESSION_BUFFER_SIZE = 200        # Lines kept per background chat until you switch to it
+DECRYPT_BATCH_WINDOW = 0.005     # Seconds the handler waits to batch a burst of PGP messages
 
-# --- GPG Binary Detection ---
-gpg_binary_path = shutil.which('gpg') or shutil.which('gpg2')
-if not gpg_binary_path:
-    common_paths = ['/usr/local/bin/gpg', '/opt/homebrew/bin/gpg', '/usr/bin/gpg']
-    for path in common_paths:
-        if os.path.exists(path):
-            gpg_binary_path = path
-            break
+# --- History Streaming ---
+DEFAULT_HISTORY_LIMIT = 20
+HISTORY_PAGE_SIZE = 100     # Messages per page (one Telegram request)
+HISTORY_PAGES_IN_FLIGHT = 3 # Pages fetched/decrypting ahead of the one being printed
+
+# --- Wire Format ---
+TELEGRAM_MESSAGE_LIMIT = 4096 # Characters per Telegram text message
+COMPACT_MARKER = 'SGC1'       # Starts every compact-format message
+COMPACT_CHUNK = 4000          # Payload characters per part, leaving room for the part header
+COMPACT_BASE = 0x4E00         # First of the 16384 CJK ideographs used as base16384 digits
+COMPACT_PART_TTL = 600        # Seconds to keep parts of an incomplete multipart message
+WIRE_FORMATS = ('armor', 'compact', 'auto')
+
+# --- File Transfer ---
+DOWNLOAD_DIR = os.path.join(SCRIPT_DIR, 'downloads') # Where /getfile puts decrypted files
+FILE_TRANSFER_BACKEND_ERROR = "File transfer needs the 'gnupg' crypto_backend"
+ENCRYPTED_FILE_SUFFIX = '.pgp'
+ENCRYPTED_FILE_CAPTION = '🔒 SilentGram encrypted file'
+PROGRESS_STEP = 10 # Percent between progress lines
+
+# --- Send Queue ---
+DEFAULT_COALESCE_WINDOW_MS = 0 # Join messages typed this close together into one (0 = off)
+SEND_MAX_RETRIES = 5           # Attempts after the first before a message is reported as failed
+SEND_RETRY_BASE_DELAY = 1.0    # Seconds; doubled on every retry of a network error
+SEND_DRAIN_TIMEOUT = 30        # Seconds /exit waits for queued messages to go out
+
+# --- Search ---
+SEARCH_RESULTS_LIMIT = 20            # Newest matches shown by /search
+SEARCH_PREFIX_MIN, SEARCH_PREFIX_MAX = 3, 10 # Word prefixes indexed for 'term*' queries
+DEFAULT_SEARCH_BACKFILL_DELAY = 2.0  # Seconds between history pages fetched by the backfill
+SEARCH_BACKFILL_IDLE = 60            # Seconds the backfill sleeps once every open chat is done
 
-if not gpg_binary_path:
-    print(f"❌ Error: Could not find 'gpg'. Please install GnuPG.")
-    sys.exit(1)
+# --- Rendering ---
+DEFAULT_RENDER_INTERVAL_MS = 16 # One screen update per frame at most; lines arriving in between are batched
 
-# Clean Slate for GPG Home
-if os.path.exists(GPG_HOME):
-    shutil.rmtree(GPG_HOME)
-os.makedirs(GPG_HOME, exist_ok=True)
+# --- Instrumentation ---
+DEFAULT_STATS_INTERVAL = 60 # Seconds between stats_file dumps
 
-gpg = gnupg.GPG(gnupghome=GPG_HOME, gpgbinary=gpg_binary_path)
+# --- Crypto Worker Pool Defaults (overridable in keys.json) ---
+DEFAULT_CRYPTO_WORKERS = 4      # gpg processes allowed to run at once
+DEFAULT_CRYPTO_MAX_PENDING = 64 # jobs allowed in flight before callers wait
+
+# --- GPG Binary Detection ---
+@functools.lru_cache(maxsize=None)
+def find_gpg_binary():
+    # Looked up on first use only, so the pgpy backend runs without GnuPG installed
+    gpg_binary_path = shutil.which('gpg') or shutil.which('gpg2')
+    if not gpg_binary_path:
+        common_paths = ['/usr/local/bin/gpg', '/opt/homebrew/bin/gpg', '/usr/bin/gpg']
+        for path in common_paths:
+            if os.path.exists(path):
+                gpg_binary_path = path
+                break
+
+    if not gpg_binary_path:
+        print(f"❌ Error: Could not find 'gpg'. Please install GnuPG.")
+        sys.exit(1)
+    return gpg_binary_path
+
+def find_gnupg_tool(name):
+    # Helpers like gpgconf usually live next to the gpg binary
+    candidate = os.path.join(os.path.dirname(find_gpg_binary()), name)
+    return candidate if os.path.exists(candidate) else shutil.which(name)
 
 style = Style.from_dict({
     'user': '#888888',       # Gray 
@@ -100,21 +177,541 @@ def get_api_credentials():
             sys.exit(1)
 
 # --- Helper Class to Track State ---
+def normalize_username(username):
+    return username.strip().lstrip('@').lower()
+
 class ChatSession:
-    def __init__(self, entity):
+    def __init__(self, entity, fingerprint=None):
         self.entity = entity
+        self.fingerprint = fingerprint # Recipient key; None = no key, encrypted sends are refused
+        self.buffer = deque(maxlen=SESSION_BUFFER_SIZE) # Lines received while in the background
+        self.unread = 0
+        self.last_line = None # Future set once the latest message's line is shown (arrival order)
+
+# --- Instrumentation ---
+class LatencyHistogram:
+    """HDR-style latency histogram: durations in microseconds are counted in
+    log-spaced buckets (16 per power of two, so ~6% precision at any scale).
+    Recording is O(1) and memory stays small however many samples arrive."""
+    SUB_BUCKET_BITS = 4
+
+    def __init__(self):
+        self.buckets = {} # bucket floor (us) -> count
+        self.count = 0
+        self.total = 0.0
+        self.min = None
+        self.max = 0.0
+
+    def record(self, seconds):
+        micros = max(1, int(seconds * 1_000_000))
+        shift = max(0, micros.bit_length() - 1 - self.SUB_BUCKET_BITS)
+        floor = (micros >> shift) << shift
+        self.buckets[floor] = self.buckets.get(floor, 0) + 1
+        self.count += 1
+        self.total += seconds
+        if self.min is None or seconds < self.min:
+            self.min = seconds
+        if seconds > self.max:
+            self.max = seconds
+
+    def percentile(self, p):
+        """Approximate p-th percentile in seconds (middle of the bucket it falls in)."""
+        if not self.count:
+            return 0.0
+        rank = max(1, int(round(p / 100 * self.count)))
+        seen = 0
+        for floor in sorted(self.buckets):
+            seen += self.buckets[floor]
+            if seen >= rank:
+                width = 1 << max(0, floor.bit_length() - 1 - self.SUB_BUCKET_BITS)
+                return min((floor + width / 2) / 1_000_000, self.max)
+        return self.max
+
+    def summary(self):
+        return {
+            "count": self.count,
+            "total_s": self.total,
+            "mean_ms": self.total / self.count * 1000 if self.count else 0.0,
+            "min_ms": (self.min or 0.0) * 1000,
+            "p50_ms": self.percentile(50) * 1000,
+            "p90_ms": self.percentile(90) * 1000,
+            "p99_ms": self.percentile(99) * 1000,
+            "max_ms": self.max * 1000,
+        }
+
+class _Timer:
+    __slots__ = ('metrics', 'name', 'start')
+
+    def __init__(self, metrics, name):
+        self.metrics = metrics
+        self.name = name
+
+    def __enter__(self):
+        self.start = time.perf_counter()
+        return self
+
+    def __exit__(self, exc_type, exc, tb):
+        self.metrics.record(self.name, time.perf_counter() - self.start)
+        if exc_type is not None:
+            self.metrics.count(self.name + '.errors')
+        return False
+
+class Metrics:
+    """Counters and latency histograms for the hot paths. When disabled, timed()
+    hands back a shared no-op context manager and count()/record() return at once.
+    Crypto worker threads record too, so every update and snapshot takes `lock`."""
+    _NOOP = contextlib.nullcontext()
+
+    def __init__(self, enabled=True):
+        self.enabled = enabled
+        self.lock = threading.Lock()
+        self.reset()
+
+    def reset(self):
+        with self.lock:
+            self.counters = {}
+            self.histograms = {}
+            self.started = time.time()
+
+    def count(self, name, n=1):
+        if self.enabled:
+            with self.lock:
+                self.counters[name] = self.counters.get(name, 0) + n
+
+    def record(self, name, seconds):
+        if not self.enabled:
+            return
+        with self.lock:
+            histogram = self.histograms.get(name)
+            if histogram is None:
+                histogram = self.histograms[name] = LatencyHistogram()
+            histogram.record(seconds)
+
+    def timed(self, name):
+        if not self.enabled:
+            return self._NOOP
+        return _Timer(self, name)
+
+    def snapshot(self):
+        with self.lock:
+            return {
+                "enabled": self.enabled,
+                "since": datetime.fromtimestamp(self.started).astimezone().isoformat(),
+                "uptime_s": time.time() - self.started,
+                "counters": dict(self.counters),
+                "latency": {name: h.summary() for name, h in sorted(self.histograms.items())},
+            }
+
+    def dump(self, path):
+        # Written next to the target and renamed, so readers never see half a file
+        tmp_path = path + '.tmp'
+        with open(tmp_path, 'w') as f:
+            json.dump(self.snapshot(), f, indent=2)
+        os.replace(tmp_path, path)
+
+METRICS = Metrics()
+
+async def dump_stats_periodically(path, interval):
+    while True:
+        await asyncio.sleep(interval)
+        try:
+            METRICS.dump(path)
+        except OSError as e:
+            print_formatted_text(HTML(f"<error>⚠️ Could not write stats to {html.escape(path)}: {html.escape(str(e))}</error>"), style=style)
+
+# --- Crypto Backends ---
+def read_key_file(path):
+    try:
+        with open(path, 'r') as key_file:
+            key_data = key_file.read()
+    except FileNotFoundError:
+        print_formatted_text(HTML(f"<error>❌ Error: File '{path}' not found.</error>"), style=style)
+        sys.exit(1)
+    if not key_data.strip():
+        print_formatted_text(HTML(f"<error>❌ Error: {path} is empty!</error>"), style=style)
+        sys.exit(1)
+    return key_data
+
+class GnuPGBackend:
+    """Runs every operation through the gpg binary (python-gnupg)."""
+    name = 'gnupg'
+    decrypt_chunk_size = 1 # Every message is its own gpg run; batching them amortizes nothing
+    file_transfer = True
+
+    def __init__(self, gpg_home, persistent_keyring=False, agent_cache_ttl=None, agent_s2k_count=None):
+        self.gpg_home = gpg_home
+        self.persistent_keyring = persistent_keyring
+        self.passphrase = None
+        self.manifest = {}
+
+        # Agent mode (agent_cache_ttl is not None): a dedicated gpg-agent for
+        # gpg_home holds the passphrase, so decrypt calls stop sending it.
+        self.agent_cache_ttl = agent_cache_ttl
+        self.agent_s2k_count = agent_s2k_count
+        self.agent_keygrips = []
+        self.agent_lock = threading.Lock()
+        self.agent_unlocked = False
+        self.agent_timer = None
+
+        # Default: clean slate on every start. Persistent mode keeps the keyring
+        # and a manifest of what was imported from which file, so unchanged keys
+        # are not re-imported.
+        if self.agent_cache_ttl is not None:
+            self.kill_agent() # Stale agent from a previous run would ignore our config
+        if not self.persistent_keyring and os.path.exists(self.gpg_home):
+            shutil.rmtree(self.gpg_home)
+        os.makedirs(self.gpg_home, mode=0o700, exist_ok=True)
+
+        if self.agent_cache_ttl is not None:
+            # Must exist before the first import: gpg-agent re-protects the
+            # private key with its own s2k-count the first time it unlocks it.
+            agent_conf = ["allow-preset-passphrase", "allow-loopback-pinentry"]
+            if self.agent_s2k_count:
+                agent_conf.append(f"s2k-count {int(self.agent_s2k_count)}")
+            with open(os.path.join(self.gpg_home, 'gpg-agent.conf'), 'w') as f:
+                f.write("\n".join(agent_conf) + "\n")
+
+        import gnupg
+        self.gpg = gnupg.GPG(gnupghome=self.gpg_home, gpgbinary=find_gpg_binary())
+
+        manifest_path = os.path.join(self.gpg_home, KEYRING_MANIFEST)
+        if self.persistent_keyring and os.path.exists(manifest_path):
+            try:
+                with open(manifest_path, 'r') as f:
+                    self.manifest = json.load(f)
+            except (OSError, json.JSONDecodeError):
+                self.manifest = {}
+
+    def save_manifest(self):
+        if not self.persistent_keyring:
+            return
+        manifest_path = os.path.join(self.gpg_home, KEYRING_MANIFEST)
+        with open(manifest_path, 'w') as f:
+            json.dump(self.manifest, f, indent=4)
+
+    def import_key_file(self, path, label):
+        """Imports a key file, or reuses the manifest entry if the file is unchanged.
+        Returns (fingerprint, first uid, imported_now)."""
+        try:
+            file_stat = os.stat(path)
+        except FileNotFoundError:
+            print_formatted_text(HTML(f"<error>❌ Error: File '{path}' not found.</error>"), style=style)
+            sys.exit(1)
+
+        entry = self.manifest.get(path)
+        if entry and entry.get('mtime_ns') == file_stat.st_mtime_ns and entry.get('size') == file_stat.st_size:
+            return entry['fingerprint'], entry['uid'], False
+
+        key_data = read_key_file(path)
+        import_result = self.gpg.import_keys(key_data)
+        if not import_result.fingerprints:
+            print_formatted_text(HTML(f"<error>❌ Failed to import {label}! (Invalid format or corrupted)</error>"), style=style)
+            sys.exit(1)
+
+        fingerprint = import_result.fingerprints[0]
+        uid = self.gpg.list_keys(keys=[fingerprint])[0]['uids'][0]
+        self.manifest[path] = {
+            'fingerprint': fingerprint,
+            'uid': uid,
+            'mtime_ns': file_stat.st_mtime_ns,
+            'size': file_stat.st_size,
+        }
+        return fingerprint, uid, True
+
+    def import_private_key(self, path, passphrase):
+        self.passphrase = passphrase
+        fingerprint, uid, _ = self.import_key_file(path, "Private Key")
+        if self.agent_cache_ttl is not None:
+            self.start_agent(fingerprint)
+        return fingerprint, uid
+
+    def import_public_key(self, path):
+        fingerprint, uid, imported = self.import_key_file(path, "Public Key")
+        if imported:
+            self.gpg.trust_keys([fingerprint], 'TRUST_ULTIMATE')
+        return fingerprint, uid
+
+    def finish_import(self):
+        self.save_manifest()
+
+    def encrypt(self, message, fingerprint):
+        encrypted_data = self.gpg.encrypt(message, fingerprint, always_trust=True)
+        if encrypted_data.ok:
+            return str(encrypted_data)
+        else:
+            return f"[Encryption Error: {encrypted_data.status}]"
+
+    def _decrypt(self, encrypted_message):
+        if self.agent_cache_ttl is not None:
+            self.ensure_agent_unlocked()
+            decrypted_data = self.gpg.decrypt(encrypted_message, extra_args=['--pinentry-mode', 'loopback'])
+            if decrypted_data.ok or not self.passphrase_problem(decrypted_data):
+                return decrypted_data # e.g. our own outgoing messages: not encrypted to us at all
+            # Agent lost the passphrase (restarted, cleared): fall through and re-arm it
+            with self.agent_lock:
+                self.agent_unlocked = False
+
+        return self.gpg.decrypt(
+            encrypted_message, 
+            passphrase=self.passphrase,
+            extra_args=['--pinentry-mode', 'loopback'] 
+        )
+
+    @staticmethod
+    def passphrase_problem(result):
+        """True if gpg failed for want of the passphrase (not e.g. 'no secret key')."""
+        if result.status in ('need passphrase', 'bad passphrase', 'missing passphrase'):
+            return True
+        # python-gnupg overwrites .status with 'decryption failed'; the status lines are in stderr
+        return any(f"[GNUPG:] {key}" in (result.stderr or '') for key in ('BAD_PASSPHRASE', 'MISSING_PASSPHRASE'))
+
+    def decrypt(self, encrypted_message):
+        decrypted_data = self._decrypt(encrypted_message)
+        return str(decrypted_data) if decrypted_data.ok else f"DECRYPTION_FAILED: {decrypted_data.stderr}"
+
+    def encrypt_bytes(self, data, fingerprint):
+        # Binary packets for the compact wire format; the caller has already compressed
+        encrypted_data = self.gpg.encrypt(data, fingerprint, always_trust=True, armor=False,
+                                          extra_args=['--compress-algo', 'none'])
+        if not encrypted_data.ok:
+            raise RuntimeError(encrypted_data.status)
+        return encrypted_data.data
+
+    def decrypt_bytes(self, data):
+        decrypted_data = self._decrypt(data)
+        if not decrypted_data.ok:
+            raise RuntimeError(decrypted_data.status or decrypted_data.stderr)
+        return decrypted_data.data
+
+    def encrypt_file(self, src, dst_path, fingerprint):
+        # gpg reads `src` in small blocks and writes straight to dst_path, so memory
+        # stays flat however large the file is
+        result = self.gpg.encrypt_file(src, fingerprint, always_trust=True, armor=False, output=dst_path)
+        if not result.ok:
+            raise RuntimeError(f"Encryption Error: {result.status}")
+
+    def decrypt_file(self, src, dst_path):
+        if self.agent_cache_ttl is not None:
+            self.ensure_agent_unlocked()
+        result = self.gpg.decrypt_file(src, passphrase=self.passphrase, output=dst_path,
+                                       extra_args=['--pinentry-mode', 'loopback'])
+        if not result.ok:
+            raise RuntimeError(f"DECRYPTION_FAILED: {result.status or result.stderr}")
+
+    # --- gpg-agent session ---
+    def agent_command(self, commands):
+        # Commands go through stdin so the passphrase never shows up in argv
+        connect_agent = find_gnupg_tool('gpg-connect-agent')
+        if not connect_agent:
+            raise RuntimeError("gpg-connect-agent not found")
+        result = subprocess.run(
+            [connect_agent, '--homedir', self.gpg_home],
+            input="\n".join(commands + ["/bye"]) + "\n",
+            capture_output=True, text=True, timeout=30,
+        )
+        errors = [line for line in result.stdout.splitlines() if line.startswith('ERR')]
+        if result.returncode != 0 or errors:
+            raise RuntimeError(result.stderr.strip() or "; ".join(errors))
+
+    def start_agent(self, fingerprint):
+        secret_keys = self.gpg.list_keys(secret=True, keys=[fingerprint])
+        if not secret_keys:
+            raise RuntimeError(f"no secret key for {fingerprint}")
+        key_info = secret_keys[0]
+        self.agent_keygrips = [key_info['keygrip']] + [sub['keygrip'] for sub in key_info.get('subkey_info', {}).values()]
+        self.agent_command(["RELOADAGENT"]) # Starts the agent, or makes a running one re-read gpg-agent.conf
+        self.ensure_agent_unlocked()
+
+    def ensure_agent_unlocked(self):
+        with self.agent_lock:
+            if self.agent_unlocked:
+                return
+            hex_passphrase = binascii.hexlify((self.passphrase or '').encode('utf-8')).decode('ascii').upper()
+            # PRESET_PASSPHRASE only supports "never expire"; the TTL is enforced by our timer
+            self.agent_command([f"PRESET_PASSPHRASE {grip} -1 {hex_passphrase}" for grip in self.agent_keygrips])
+            self.agent_unlocked = True
+            if self.agent_timer:
+                self.agent_timer.cancel() # Only the newest preset's timer may clear it
+            if self.agent_cache_ttl:
+                self.agent_timer = threading.Timer(self.agent_cache_ttl, self.forget_agent_passphrase)
+                self.agent_timer.daemon = True
+                self.agent_timer.start()
+
+    def forget_agent_passphrase(self):
+        with self.agent_lock:
+            if self.agent_timer:
+                self.agent_timer.cancel()
+                self.agent_timer = None
+            if not self.agent_unlocked:
+                return
+            self.agent_unlocked = False
+            try:
+                self.agent_command([f"CLEAR_PASSPHRASE --mode=normal {grip}" for grip in self.agent_keygrips])
+            except Exception:
+                pass # Agent already gone
+
+    def kill_agent(self):
+        gpgconf = find_gnupg_tool('gpgconf')
+        if gpgconf and os.path.exists(self.gpg_home):
+            subprocess.run([gpgconf, '--homedir', self.gpg_home, '--kill', 'gpg-agent'], capture_output=True, timeout=30)
+
+    def shutdown(self):
+        if self.agent_cache_ttl is not None:
+            self.forget_agent_passphrase()
+            self.kill_agent()
+
+class PGPyBackend:
+    """In-process OpenPGP (PGPy). Keys are parsed and unlocked once at startup,
+    so encrypt/decrypt never spawn a process."""
+    name = 'pgpy'
+    decrypt_chunk_size = 4 # ~2 ms each: a few per pool hop, still one quick job
+    file_transfer = False # See encrypt_file
 
-class PGPEngine:
     def __init__(self):
+        import warnings
+        # PGPy still references legacy ciphers that newer 'cryptography' flags as deprecated
+        warnings.filterwarnings('ignore', module=r'pgpy\.')
+        try:
+            import pgpy
+        except ImportError:
+            print_formatted_text(HTML("<error>❌ The 'pgpy' backend needs PGPy. Install it with: pip install pgpy</error>"), style=style)
+            sys.exit(1)
+        self.pgpy = pgpy
+        self.private_key = None
+        self.public_keys = {}   # fingerprint -> PGPKey
+        self.unlock_stack = contextlib.ExitStack() # Holds key.unlock() open until shutdown()
+        self.private_key_objects = {} # (sub)key fingerprint -> prebuilt private key object
+        self.patched_key_materials = []
+
+    def load_key(self, path, label):
+        try:
+            key, _ = self.pgpy.PGPKey.from_blob(read_key_file(path))
+        except Exception:
+            print_formatted_text(HTML(f"<error>❌ Failed to import {label}! (Invalid format or corrupted)</error>"), style=style)
+            sys.exit(1)
+        uid = str(key.userids[0].userid) if key.userids else str(key.fingerprint)
+        return key, str(key.fingerprint).replace(' ', ''), uid
+
+    def import_private_key(self, path, passphrase):
+        key, fingerprint, uid = self.load_key(path, "Private Key")
+        if key.is_public:
+            print_formatted_text(HTML(f"<error>❌ {path} does not contain a private key.</error>"), style=style)
+            sys.exit(1)
+
+        if key.is_protected:
+            # Entered once and left open for the session: the S2K derivation
+            # runs here instead of on every message. Closed again in shutdown().
+            try:
+                self.unlock_stack.enter_context(key.unlock(passphrase or ''))
+            except self.pgpy.errors.PGPDecryptionError:
+                print_formatted_text(HTML("<error>❌ Could not unlock Private Key: wrong passphrase.</error>"), style=style)
+                sys.exit(1)
+
+        # PGPy rebuilds (and re-validates) the RSA/EC key object on every
+        # private-key operation, ~100 ms for RSA-2048; build it once per (sub)key.
+        # PGPy has no hook for this, so the key material's __privkey__ is pointed
+        # at our dict; shutdown() removes both.
+        for sub_key in [key, *key.subkeys.values()]:
+            key_material = sub_key._key.keymaterial
+            try:
+                self.private_key_objects[sub_key.fingerprint] = key_material.__privkey__()
+            except Exception:
+                continue
+            key_material.__privkey__ = functools.partial(self.private_key_objects.__getitem__, sub_key.fingerprint)
+            self.patched_key_materials.append(key_material)
+
+        self.private_key = key
+        self.public_keys[fingerprint] = key.pubkey
+        return fingerprint, uid
+
+    def import_public_key(self, path):
+        key, fingerprint, uid = self.load_key(path, "Public Key")
+        self.public_keys[fingerprint] = key if key.is_public else key.pubkey
+        return fingerprint, uid
+
+    def finish_import(self):
+        pass
+
+    def encrypt(self, message, fingerprint):
+        try:
+            encrypted_data = self.public_keys[fingerprint].encrypt(self.pgpy.PGPMessage.new(message))
+            return str(encrypted_data)
+        except Exception as e:
+            return f"[Encryption Error: {e}]"
+
+    def decrypt(self, encrypted_message):
+        try:
+            decrypted_data = self.private_key.decrypt(self.pgpy.PGPMessage.from_blob(encrypted_message))
+            message = decrypted_data.message
+            return message.decode('utf-8', 'replace') if isinstance(message, (bytes, bytearray)) else str(message)
+        except Exception as e:
+            return f"DECRYPTION_FAILED: {e}"
+
+    def encrypt_bytes(self, data, fingerprint):
+        message = self.pgpy.PGPMessage.new(data, compression=self.pgpy.constants.CompressionAlgorithm.Uncompressed)
+        return bytes(self.public_keys[fingerprint].encrypt(message))
+
+    def decrypt_bytes(self, data):
+        message = self.private_key.decrypt(self.pgpy.PGPMessage.from_blob(data)).message
+        return message.encode('utf-8') if isinstance(message, str) else bytes(message)
+
+    def encrypt_file(self, src, dst_path, fingerprint):
+        # PGPy builds the whole message in memory, which is no good for large files
+        raise RuntimeError(FILE_TRANSFER_BACKEND_ERROR)
+
+    def decrypt_file(self, src, dst_path):
+        raise RuntimeError(FILE_TRANSFER_BACKEND_ERROR)
+
+    def shutdown(self):
+        # Drops our prebuilt key objects and has PGPy clear the decrypted key
+        # material (what Python lets us clear: freed memory is not overwritten)
+        for key_material in self.patched_key_materials:
+            key_material.__dict__.pop('__privkey__', None)
+        self.patched_key_materials.clear()
+        self.private_key_objects.clear()
+        self.unlock_stack.close()
+        if self.private_key is not None:
+            for sub_key in [self.private_key, *self.private_key.subkeys.values()]:
+                sub_key._key.keymaterial.clear() # Also for keys without a passphrase
+            self.private_key = None
+
+class PGPEngine:
+    def __init__(self, keys_file=None, gpg_home=None):
+        self.keys_file = keys_file or KEYS_FILE
+        self.gpg_home = gpg_home or GPG_HOME
+        self.backend = None
         self.target_fingerprint = None
+        self.contacts = {} # normalized username -> fingerprint
         self.passphrase = None
         self.default_username = None
+        self.private_key_path = None
+        self.crypto_workers = DEFAULT_CRYPTO_WORKERS
+        self.crypto_max_pending = DEFAULT_CRYPTO_MAX_PENDING
+        self.message_cache_enabled = False
+        self.message_cache_max_entries = DEFAULT_CACHE_MAX_ENTRIES
+        self.stats_enabled = True
+        self.stats_file = None
+        self.stats_interval = DEFAULT_STATS_INTERVAL
+        self.coalesce_window_ms = DEFAULT_COALESCE_WINDOW_MS
+        self.render_interval_ms = DEFAULT_RENDER_INTERVAL_MS
+        self.search_index_enabled = False
+        self.search_backfill_delay = DEFAULT_SEARCH_BACKFILL_DELAY
+        self.wire_format = 'armor'
         self.check_and_create_files()
         self.load_keys()
 
+        # gpg does its work in a subprocess (and PGPy's RSA/EC math runs in
+        # 'cryptography'), so threads are enough to keep encrypt/decrypt off
+        # the event loop. The semaphore bounds how many
+        # jobs can be queued at once; extra callers wait (backpressure).
+        self.executor = ThreadPoolExecutor(max_workers=self.crypto_workers, thread_name_prefix='sg-crypto')
+        self.crypto_slots = None # Created on first use, on the event loop (the engine may be built in a thread)
+        # Background work (search backfill) gets one worker of its own and never queues on the chat's pool
+        self.background_executor = ThreadPoolExecutor(max_workers=1, thread_name_prefix='sg-background')
+
     def check_and_create_files(self):
-        if not os.path.exists(KEYS_FILE):
-            print_formatted_text(HTML(f"<system>⚠️ {KEYS_FILE} not found. Creating default configuration...</system>"), style=style)
+        if not os.path.exists(self.keys_file):
+            print_formatted_text(HTML(f"<system>⚠️ {self.keys_file} not found. Creating default configuration...</system>"), style=style)
             
             default_config = {
                 "my_private_key": "my_private.asc",
@@ -123,7 +720,7 @@ class PGPEngine:
                 "target_username": ""
             }
             
-            with open(KEYS_FILE, 'w') as f:
+            with open(self.keys_file, 'w') as f:
                 json.dump(default_config, f, indent=4)
 
             priv_key_path = os.path.join(SCRIPT_DIR, "my_private.asc")
@@ -144,8 +741,9 @@ class PGPEngine:
 
     def load_keys(self):
         try:
+            start_time = time.perf_counter()
             print_formatted_text(HTML("<system>📂 Reading configuration...</system>"), style=style)
-            with open(KEYS_FILE, 'r') as f:
+            with open(self.keys_file, 'r') as f:
                 try:
                     data = json.load(f)
                 except json.JSONDecodeError:
@@ -157,304 +755,2115 @@ class PGPEngine:
 
             priv_path = resolve_path(data['my_private_key'])
             pub_path = resolve_path(data['friends_public_key'])
+            self.private_key_path = priv_path
 
-            # Load Private Key
-            print_formatted_text(HTML(f"<user>   > Loading Private Key: {priv_path}</user>"), style=style)
-            try:
-                with open(priv_path, 'r') as key_file:
-                    key_data = key_file.read()
-                    if not key_data.strip():
-                         print_formatted_text(HTML(f"<error>❌ Error: {priv_path} is empty!</error>"), style=style)
-                         sys.exit(1)
-                    import_result = gpg.import_keys(key_data)
-            except FileNotFoundError:
-                print_formatted_text(HTML(f"<error>❌ Error: File '{priv_path}' not found.</error>"), style=style)
-                sys.exit(1)
-            
-            if not import_result.fingerprints:
-                print_formatted_text(HTML("<error>❌ Failed to import Private Key! (Invalid format or corrupted)</error>"), style=style)
+            backend_name = data.get('crypto_backend', GnuPGBackend.name)
+            if backend_name == GnuPGBackend.name:
+                agent_cache_ttl = None
+                agent_s2k_count = None
+                if data.get('gpg_agent', False):
+                    agent_cache_ttl = max(0, int(data.get('agent_cache_ttl', DEFAULT_AGENT_CACHE_TTL)))
+                    agent_s2k_count = data.get('agent_s2k_count') # None: gpg-agent's own default
+                self.backend = GnuPGBackend(self.gpg_home, bool(data.get('persistent_keyring', False)), agent_cache_ttl, agent_s2k_count)
+            elif backend_name == PGPyBackend.name:
+                self.backend = PGPyBackend()
+            else:
+                print_formatted_text(HTML(f"<error>❌ Unknown crypto_backend '{html.escape(str(backend_name))}'. Use 'gnupg' or 'pgpy'.</error>"), style=style)
                 sys.exit(1)
 
-            my_fp = import_result.fingerprints[0]
-            my_id = gpg.list_keys(keys=[my_fp])[0]['uids'][0]
-            print_formatted_text(HTML(f"<info>   ✅ Loaded Identity: {my_id}</info>"), style=style)
-
             self.passphrase = data.get('my_private_key_passphrase', '')
 
+            # Load Private Key
+            print_formatted_text(HTML(f"<user>   > Loading Private Key: {priv_path}</user>"), style=style)
+            my_fp, my_id = self.backend.import_private_key(priv_path, self.passphrase)
+            print_formatted_text(HTML(f"<info>   ✅ Loaded Identity: {html.escape(my_id)}</info>"), style=style)
+
             # Load Friend's Key
             print_formatted_text(HTML(f"<user>   > Loading Friend's Key: {pub_path}</user>"), style=style)
-            try:
-                with open(pub_path, 'r') as key_file:
-                    key_data = key_file.read()
-                    if not key_data.strip():
-                         print_formatted_text(HTML(f"<error>❌ Error: {pub_path} is empty!</error>"), style=style)
-                         sys.exit(1)
-                    import_result = gpg.import_keys(key_data)
-            except FileNotFoundError:
-                print_formatted_text(HTML(f"<error>❌ Error: File '{pub_path}' not found.</error>"), style=style)
-                sys.exit(1)
-            
-            if not import_result.fingerprints:
-                print_formatted_text(HTML("<error>❌ Failed to import Public Key! (Invalid format or corrupted)</error>"), style=style)
-                sys.exit(1)
+            self.target_fingerprint, friend_id = self.backend.import_public_key(pub_path)
+            print_formatted_text(HTML(f"<info>   ✅ Loaded Friend: {html.escape(friend_id)}</info>"), style=style)
 
-            self.target_fingerprint = import_result.fingerprints[0]
-            friend_id = gpg.list_keys(keys=[self.target_fingerprint])[0]['uids'][0]
-            print_formatted_text(HTML(f"<info>   ✅ Loaded Friend: {friend_id}</info>"), style=style)
+            # Contacts: username -> key file (or fingerprint of a key already in
+            # the keyring), indexed once so switching chats never touches gpg
+            for username, key_ref in data.get('contacts', {}).items():
+                compact_ref = key_ref.replace(' ', '')
+                if re.fullmatch(r'[0-9A-Fa-f]{40}', compact_ref):
+                    self.contacts[normalize_username(username)] = compact_ref.upper()
+                    continue
+                contact_path = resolve_path(key_ref)
+                print_formatted_text(HTML(f"<user>   > Loading Key for {html.escape(username)}: {contact_path}</user>"), style=style)
+                contact_fp, contact_id = self.backend.import_public_key(contact_path)
+                self.contacts[normalize_username(username)] = contact_fp
+                print_formatted_text(HTML(f"<info>   ✅ Loaded Contact: {html.escape(contact_id)}</info>"), style=style)
 
-            gpg.trust_keys([self.target_fingerprint], 'TRUST_ULTIMATE')
+            self.backend.finish_import()
             
             self.default_username = data.get('target_username')
             if self.default_username == "":
                 self.default_username = None
 
-            print_formatted_text(HTML("<system>🚀 System Ready.</system>"), style=style)
+            self.crypto_workers = max(1, int(data.get('crypto_workers', DEFAULT_CRYPTO_WORKERS)))
+            self.crypto_max_pending = max(self.crypto_workers, int(data.get('crypto_max_pending', DEFAULT_CRYPTO_MAX_PENDING)))
+
+            self.message_cache_enabled = bool(data.get('message_cache', False))
+            self.message_cache_max_entries = max(1, int(data.get('message_cache_max_entries', DEFAULT_CACHE_MAX_ENTRIES)))
+
+            self.stats_enabled = bool(data.get('stats', True))
+            self.stats_file = data.get('stats_file') or None
+            if self.stats_file:
+                self.stats_file = resolve_path(self.stats_file)
+            self.stats_interval = max(1, float(data.get('stats_interval', DEFAULT_STATS_INTERVAL)))
+
+            self.coalesce_window_ms = max(0, int(data.get('coalesce_window_ms', DEFAULT_COALESCE_WINDOW_MS)))
+            self.render_interval_ms = max(0, int(data.get('render_interval_ms', DEFAULT_RENDER_INTERVAL_MS)))
+
+            self.search_index_enabled = bool(data.get('search_index', False))
+            self.wire_format = data.get('wire_format', 'armor')
+            if self.wire_format not in WIRE_FORMATS:
+                print_formatted_text(HTML(f"<error>❌ Unknown wire_format '{html.escape(str(self.wire_format))}'. Use {', '.join(WIRE_FORMATS)}.</error>"), style=style)
+                sys.exit(1)
+            self.search_backfill_delay = max(0.1, float(data.get('search_backfill_delay', DEFAULT_SEARCH_BACKFILL_DELAY)))
+
+            elapsed_ms = (time.perf_counter() - start_time) * 1000
+            print_formatted_text(HTML(f"<system>🚀 System Ready. ({self.backend.name}, {elapsed_ms:.0f} ms)</system>"), style=style)
 
         except Exception as e:
             print(f"❌ Unexpected Error: {e}")
             sys.exit(1)
 
-    def encrypt(self, message):
-        encrypted_data = gpg.encrypt(message, self.target_fingerprint, always_trust=True)
-        if encrypted_data.ok:
-            return str(encrypted_data)
-        else:
-            return f"[Encryption Error: {encrypted_data.status}]"
+    def fingerprint_for(self, username):
+        """Key to encrypt to for a username: its contacts entry, else friends_public_key
+        if it is target_username, else None (we have no key for them)."""
+        username = normalize_username(username or '')
+        if username in self.contacts:
+            return self.contacts[username]
+        if self.default_username and username == normalize_username(self.default_username):
+            return self.target_fingerprint
+        return None
+
+    def encrypt(self, message, fingerprint=None):
+        with METRICS.timed('pgp.encrypt'):
+            return self.backend.encrypt(message, fingerprint or self.target_fingerprint)
 
     def decrypt(self, encrypted_message):
-        decrypted_data = gpg.decrypt(
-            encrypted_message, 
-            passphrase=self.passphrase,
-            extra_args=['--pinentry-mode', 'loopback'] 
-        )
-        return str(decrypted_data) if decrypted_data.ok else f"DECRYPTION_FAILED: {decrypted_data.stderr}"
+        """Decrypts an armored block or a (reassembled) compact message."""
+        with METRICS.timed('pgp.decrypt'):
+            part = parse_compact(encrypted_message)
+            if part is None:
+                return self.backend.decrypt(encrypted_message)
+            try:
+                packet = self.backend.decrypt_bytes(decode_base16384(part[3]))
+                return zlib.decompress(packet).decode('utf-8')
+            except Exception as e:
+                return f"DECRYPTION_FAILED: {e}"
 
-async def main():
-    # 1. Load API Keys first
-    api_id, api_hash = get_api_credentials()
+    def encrypt_for_wire(self, message, fingerprint=None):
+        """The Telegram message(s) to send for `message` in the configured wire_format:
+        'armor' is standard PGP, 'compact' always the denser SilentGram format, and
+        'auto' armor unless it would not fit in one Telegram message."""
+        if self.wire_format != 'compact':
+            armored = self.encrypt(message, fingerprint)
+            if self.wire_format == 'armor' or len(armored) <= TELEGRAM_MESSAGE_LIMIT or armored.startswith("[Encryption Error"):
+                return [armored]
+        try:
+            with METRICS.timed('pgp.encrypt'):
+                packet = self.backend.encrypt_bytes(zlib.compress(message.encode('utf-8'), 9), fingerprint or self.target_fingerprint)
+        except Exception as e:
+            return [f"[Encryption Error: {e}]"]
+        return split_compact(encode_base16384(packet))
 
-    pgp = PGPEngine()
-    client = TelegramClient(SESSION_FILE, api_id, api_hash)
-    
-    await client.start()
+    def encrypt_file(self, src, dst_path, fingerprint=None):
+        """Encrypts the binary file object `src` into dst_path. Raises RuntimeError on failure."""
+        with METRICS.timed('pgp.encrypt_file'):
+            self.backend.encrypt_file(src, dst_path, fingerprint or self.target_fingerprint)
 
-    # --- SETUP PHASE ---
-    current_chat = None 
-    target_user = pgp.default_username
-    encryption_enabled = True 
-    
-    if not target_user:
-        print_formatted_text(HTML("<system>⚠️ No 'target_username' found in keys.json.</system>"), style=style)
-        
-        while not target_user:
-             print("Please enter the recipient username (e.g. @friend): ", end="", flush=True)
-             target_user = sys.stdin.readline().strip()
-             
-             if not target_user:
-                 print("Username cannot be empty.")
+    def decrypt_file(self, src, dst_path):
+        with METRICS.timed('pgp.decrypt_file'):
+            self.backend.decrypt_file(src, dst_path)
+
+    def storage_secret(self):
+        """Secret for encrypting local files: derivable only with the private key file and its passphrase."""
+        key_data = read_key_file(self.private_key_path)
+        return hashlib.sha256(key_data.encode('utf-8') + b'\0' + (self.passphrase or '').encode('utf-8')).digest()
+
+    async def _run_in_pool(self, func, *args):
+        queued_at = time.perf_counter()
+        if self.crypto_slots is None:
+            self.crypto_slots = asyncio.Semaphore(self.crypto_max_pending)
+        async with self.crypto_slots:
+            loop = asyncio.get_running_loop()
+            if not METRICS.enabled:
+                return await loop.run_in_executor(self.executor, func, *args)
+
+            def run():
+                # Time spent waiting for a slot and a free worker thread
+                METRICS.record('crypto.queue_wait', time.perf_counter() - queued_at)
+                return func(*args)
+            return await loop.run_in_executor(self.executor, run)
+
+    def decrypt_batch(self, encrypted_messages):
+        # Runs inside one worker: one pool hop and one semaphore slot for a small chunk
+        results = []
+        for encrypted_message in encrypted_messages:
+            try:
+                results.append(self.decrypt(encrypted_message))
+            except Exception as e:
+                results.append(f"DECRYPTION_FAILED: {e}")
+        return results
+
+    def decrypt_chunks(self, items):
+        """`items` in chunks of the backend's decrypt_chunk_size, in order."""
+        size = self.backend.decrypt_chunk_size
+        return [items[i:i + size] for i in range(0, len(items), size)]
 
+    async def decrypt_chunk_async(self, encrypted_messages):
+        return await self._run_in_pool(self.decrypt_batch, encrypted_messages)
+
+    async def decrypt_many(self, encrypted_messages):
+        """Decrypts a list of armored blocks and returns the results in the same order.
+        Failures come back as DECRYPTION_FAILED strings without aborting the batch.
+        The list goes to the pool in small fixed-size chunks, so no single job holds
+        a worker for long and the first messages are done first."""
+        encrypted_messages = list(encrypted_messages)
+        if not encrypted_messages:
+            return []
+        chunk_results = await asyncio.gather(*(self.decrypt_chunk_async(chunk) for chunk in self.decrypt_chunks(encrypted_messages)))
+        return [result for chunk in chunk_results for result in chunk]
+
+    async def decrypt_many_in_background(self, encrypted_messages):
+        """decrypt_many for background work: one message per job on the single
+        background worker, resting as long as each decrypt took. It uses at most
+        half of one worker and never delays the chat's own decrypts."""
+        loop = asyncio.get_running_loop()
+        results = []
+        for encrypted_message in encrypted_messages:
+            started = time.perf_counter()
+            try:
+                results.append(await loop.run_in_executor(self.background_executor, self.decrypt, encrypted_message))
+            except Exception as e:
+                results.append(f"DECRYPTION_FAILED: {e}")
+            await asyncio.sleep(time.perf_counter() - started)
+        return results
+
+    async def encrypt_file_async(self, src, dst_path, fingerprint=None):
+        # Not through crypto_slots: a file can take minutes and must not hold up chat messages
+        loop = asyncio.get_running_loop()
+        return await loop.run_in_executor(None, self.encrypt_file, src, dst_path, fingerprint)
+
+    async def decrypt_file_async(self, src, dst_path):
+        loop = asyncio.get_running_loop()
+        return await loop.run_in_executor(None, self.decrypt_file, src, dst_path)
+
+    async def encrypt_async(self, message, fingerprint=None):
+        return await self._run_in_pool(self.encrypt, message, fingerprint)
+
+    async def encrypt_for_wire_async(self, message, fingerprint=None):
+        return await self._run_in_pool(self.encrypt_for_wire, message, fingerprint)
+
+    async def decrypt_async(self, encrypted_message):
+        return await self._run_in_pool(self.decrypt, encrypted_message)
+
+    def shutdown(self):
+        self.executor.shutdown(wait=False)
+        self.background_executor.shutdown(wait=False)
+        self.backend.shutdown()
+
+class DecryptBatcher:
+    """Collects decrypt requests that arrive within `window` seconds of each other
+    (a burst of updates) and sends them to the pool in decrypt_many's chunks. Each
+    request is answered as soon as its own chunk is done, not the whole burst."""
+
+    def __init__(self, pgp, window=DECRYPT_BATCH_WINDOW):
+        self.pgp = pgp
+        self.window = window
+        self.pending = []
+        self.flush_task = None
+
+    async def decrypt(self, encrypted_message):
+        future = asyncio.get_running_loop().create_future()
+        self.pending.append((encrypted_message, future))
+        if self.flush_task is None:
+            self.flush_task = asyncio.ensure_future(self.flush())
+        return await future
+
+    async def flush(self):
+        await asyncio.sleep(self.window)
+        batch, self.pending, self.flush_task = self.pending, [], None
+        await asyncio.gather(*(self.decrypt_chunk(chunk) for chunk in self.pgp.decrypt_chunks(batch)))
+
+    async def decrypt_chunk(self, chunk):
         try:
-            with open(KEYS_FILE, 'r') as f:
-                config_data = json.load(f)
-            config_data['target_username'] = target_user
-            with open(KEYS_FILE, 'w') as f:
-                json.dump(config_data, f, indent=4)
-            print_formatted_text(HTML(f"<system>💾 Saved '{target_user}' to {KEYS_FILE}</system>"), style=style)
+            results = await self.pgp.decrypt_chunk_async([encrypted_message for encrypted_message, _ in chunk])
         except Exception as e:
-             print_formatted_text(HTML(f"<error>⚠️ Failed to save recipient to JSON: {e}</error>"), style=style)
+            results = [f"DECRYPTION_FAILED: {e}"] * len(chunk)
+        for (_, future), result in zip(chunk, results):
+            if not future.done():
+                future.set_result(result)
+
+# --- Wire Format ---
+# Compact messages: zlib-compressed plaintext, encrypted to binary OpenPGP packets,
+# written in base16384 (14 bits per character, CJK ideographs U+4E00..U+8DFF)
+# instead of armor's 6. Telegram's limit counts characters, so a message needs
+# ~2.4x fewer of them. Longer ones are split as "SGC1 <group>/<i>/<n> <chunk>".
+COMPACT_PATTERN = re.compile(COMPACT_MARKER + r' (?:([0-9a-f]{6})/(\d+)/(\d+) )?([\u4e00-\u8dff]+={0,6})\Z')
+
+def encode_base16384(data):
+    pad = -len(data) % 7 # 7 bytes = 56 bits = 4 characters
+    data += b'\0' * pad
+    chars = []
+    for i in range(0, len(data), 7):
+        n = int.from_bytes(data[i:i + 7], 'big')
+        chars.append(chr(COMPACT_BASE + (n >> 42)) + chr(COMPACT_BASE + (n >> 28 & 0x3FFF)) +
+                     chr(COMPACT_BASE + (n >> 14 & 0x3FFF)) + chr(COMPACT_BASE + (n & 0x3FFF)))
+    return ''.join(chars) + '=' * pad
+
+def decode_base16384(text):
+    body = text.rstrip('=')
+    pad = len(text) - len(body)
+    if len(body) % 4 or pad > 6:
+        raise ValueError("malformed compact payload")
+    out = bytearray()
+    for i in range(0, len(body), 4):
+        n = 0
+        for char in body[i:i + 4]:
+            digit = ord(char) - COMPACT_BASE
+            if not 0 <= digit < 0x4000:
+                raise ValueError("malformed compact payload")
+            n = n << 14 | digit
+        out += n.to_bytes(7, 'big')
+    return bytes(out[:len(out) - pad])
+
+def split_compact(payload):
+    if len(payload) + len(COMPACT_MARKER) + 1 <= TELEGRAM_MESSAGE_LIMIT:
+        return [f"{COMPACT_MARKER} {payload}"]
+    chunks = [payload[i:i + COMPACT_CHUNK] for i in range(0, len(payload), COMPACT_CHUNK)]
+    group = os.urandom(3).hex()
+    return [f"{COMPACT_MARKER} {group}/{i}/{len(chunks)} {chunk}" for i, chunk in enumerate(chunks, 1)]
+
+def parse_compact(text):
+    """(group, index, count, payload) for a compact message, else None. Single
+    messages have group None and index/count 1."""
+    if not text.startswith(COMPACT_MARKER):
+        return None
+    match = COMPACT_PATTERN.match(text)
+    if not match:
+        return None
+    group, index, count, payload = match.groups()
+    if group is None:
+        return None, 1, 1, payload
+    index, count = int(index), int(count)
+    if not 1 <= index <= count:
+        return None
+    return group, index, count, payload
+
+def is_encrypted_text(text):
+    return "BEGIN PGP MESSAGE" in text or parse_compact(text) is not None
+
+class CompactAssembler:
+    """Collects the parts of multipart compact messages. add() returns
+    (single-message text, ids of all parts) once the last part is in."""
+
+    def __init__(self):
+        self.groups = {} # (chat id, group) -> {'count', 'parts': {index: (message id, chunk)}, 'seen'}
+
+    def add(self, chat_id, message_id, part):
+        group, index, count, payload = part
+        now = time.monotonic()
+        for key in [k for k, g in self.groups.items() if now - g['seen'] > COMPACT_PART_TTL]:
+            del self.groups[key]
+        entry = self.groups.setdefault((chat_id, group), {'count': count, 'parts': {}, 'seen': now})
+        entry['parts'][index] = (message_id, payload)
+        entry['seen'] = now
+        if len(entry['parts']) < entry['count']:
+            return None
+        del self.groups[(chat_id, group)]
+        parts = [entry['parts'][i] for i in sorted(entry['parts'])]
+        return f"{COMPACT_MARKER} " + ''.join(chunk for _, chunk in parts), [message_id for message_id, _ in parts]
+
+# --- Local Encrypted Storage ---
+class SealedBox:
+    """Authenticated encryption using only the standard library: an HMAC-SHA256
+    keystream in counter mode, then an HMAC-SHA256 tag over nonce + ciphertext."""
+    NONCE_SIZE = 16
+    TAG_SIZE = 32
+
+    def __init__(self, key):
+        self.enc_key = hmac.new(key, b'silentgram-enc', hashlib.sha256).digest()
+        self.mac_key = hmac.new(key, b'silentgram-mac', hashlib.sha256).digest()
+        self.id_key = hmac.new(key, b'silentgram-id', hashlib.sha256).digest()
+
+    def _keystream(self, nonce, length):
+        blocks = (hmac.new(self.enc_key, nonce + counter.to_bytes(8, 'big'), hashlib.sha256).digest()
+                  for counter in range((length + 31) // 32))
+        return b''.join(blocks)[:length]
+
+    def _xor(self, data, nonce):
+        if not data:
+            return b''
+        stream = self._keystream(nonce, len(data))
+        return (int.from_bytes(data, 'big') ^ int.from_bytes(stream, 'big')).to_bytes(len(data), 'big')
+
+    def seal(self, plaintext):
+        nonce = os.urandom(self.NONCE_SIZE)
+        ciphertext = self._xor(plaintext, nonce)
+        tag = hmac.new(self.mac_key, nonce + ciphertext, hashlib.sha256).digest()
+        return nonce + ciphertext + tag
+
+    def open(self, blob):
+        if len(blob) < self.NONCE_SIZE + self.TAG_SIZE:
+            raise ValueError("sealed data is truncated")
+        nonce, ciphertext, tag = blob[:self.NONCE_SIZE], blob[self.NONCE_SIZE:-self.TAG_SIZE], blob[-self.TAG_SIZE:]
+        expected = hmac.new(self.mac_key, nonce + ciphertext, hashlib.sha256).digest()
+        if not hmac.compare_digest(tag, expected):
+            raise ValueError("sealed data failed authentication")
+        return self._xor(ciphertext, nonce)
+
+    def blind_id(self, *parts):
+        # Deterministic lookup key that does not reveal chat/message ids on disk
+        return hmac.new(self.id_key, ":".join(str(p) for p in parts).encode('utf-8'), hashlib.sha256).digest()
+
+def open_encrypted_db(path, secret):
+    """Opens (or creates) a SQLite file whose sensitive columns are sealed with a key
+    derived from `secret`. Returns (connection, SealedBox). If the file was written
+    with a different key, its tables are emptied."""
+    if not os.path.exists(path):
+        os.close(os.open(path, os.O_CREAT | os.O_WRONLY, 0o600))
+    db = sqlite3.connect(path)
+    db.execute("CREATE TABLE IF NOT EXISTS meta (name TEXT PRIMARY KEY, value BLOB NOT NULL)")
+
+    row = db.execute("SELECT value FROM meta WHERE name = 'salt'").fetchone()
+    salt = row[0] if row else os.urandom(16)
+    box = SealedBox(hashlib.scrypt(secret, salt=salt, n=2**14, r=8, p=1, dklen=32))
+
+    check = db.execute("SELECT value FROM meta WHERE name = 'check'").fetchone()
+    valid = False
+    if check:
+        try:
+            valid = box.open(check[0]) == b'silentgram'
+        except ValueError:
+            valid = False
+    if not valid:
+        # New file or different key: nothing in it can be read anyway
+        tables = [r[0] for r in db.execute("SELECT name FROM sqlite_master WHERE type = 'table' AND name != 'meta'")]
+        with db:
+            for table in tables:
+                db.execute(f"DROP TABLE {table}")
+            db.execute("INSERT OR REPLACE INTO meta (name, value) VALUES ('salt', ?)", (salt,))
+            db.execute("INSERT OR REPLACE INTO meta (name, value) VALUES ('check', ?)", (box.seal(b'silentgram'),))
+    return db, box
+
+def wipe_db_file(path):
+    for suffix in ('', '-journal', '-wal', '-shm'):
+        if os.path.exists(path + suffix):
+            os.remove(path + suffix)
+
+class MessageCache:
+    """Decrypted plaintext keyed by (chat id, message id, edit date), encrypted at
+    rest, evicting the least recently used entries beyond max_entries."""
+
+    def __init__(self, path, secret, max_entries=DEFAULT_CACHE_MAX_ENTRIES):
+        self.path = path
+        self.max_entries = max_entries
+        self.db, self.box = open_encrypted_db(path, secret)
+        self.db.execute("""CREATE TABLE IF NOT EXISTS messages (
+            lookup BLOB PRIMARY KEY,
+            payload BLOB NOT NULL,
+            last_used REAL NOT NULL)""")
+        self.db.execute("CREATE INDEX IF NOT EXISTS messages_last_used ON messages (last_used)")
+        self.db.commit()
+        self.entries = self.db.execute("SELECT COUNT(*) FROM messages").fetchone()[0]
+
+    @staticmethod
+    def edit_stamp(edit_date):
+        return int(edit_date.timestamp()) if edit_date else 0
+
+    def get_many(self, chat_id, keys):
+        """keys: [(message id, edit date)]. Returns {message id: plaintext} for the hits."""
+        lookups = {self.box.blind_id(chat_id, msg_id, self.edit_stamp(edit_date)): msg_id for msg_id, edit_date in keys}
+        if not lookups:
+            return {}
+        hits = {}
+        lookup_list = list(lookups)
+        for i in range(0, len(lookup_list), 500): # Stay under SQLite's bound-parameter limit
+            chunk = lookup_list[i:i + 500]
+            placeholders = ",".join("?" * len(chunk))
+            for lookup, payload in self.db.execute(f"SELECT lookup, payload FROM messages WHERE lookup IN ({placeholders})", chunk):
+                try:
+                    hits[lookup] = self.box.open(payload).decode('utf-8')
+                except ValueError:
+                    continue
+        if hits:
+            now = time.time()
+            with self.db:
+                self.db.executemany("UPDATE messages SET last_used = ? WHERE lookup = ?", [(now, lookup) for lookup in hits])
+        return {lookups[lookup]: text for lookup, text in hits.items()}
+
+    def put_many(self, chat_id, entries):
+        """entries: [(message id, edit date, plaintext)]."""
+        if not entries:
+            return
+        now = time.time()
+        rows = [(self.box.blind_id(chat_id, msg_id, self.edit_stamp(edit_date)), self.box.seal(text.encode('utf-8')), now)
+                for msg_id, edit_date, text in entries]
+        with self.db:
+            self.db.executemany("INSERT OR REPLACE INTO messages (lookup, payload, last_used) VALUES (?, ?, ?)", rows)
+        self.entries += len(rows)
+        if self.entries > self.max_entries:
+            self.evict()
+
+    def put(self, chat_id, msg_id, edit_date, text):
+        self.put_many(chat_id, [(msg_id, edit_date, text)])
+
+    def evict(self):
+        with self.db:
+            self.entries = self.db.execute("SELECT COUNT(*) FROM messages").fetchone()[0]
+            excess = self.entries - self.max_entries
+            if excess > 0:
+                self.db.execute("DELETE FROM messages WHERE lookup IN (SELECT lookup FROM messages ORDER BY last_used LIMIT ?)", (excess,))
+                self.entries -= excess
+
+    def close(self):
+        self.db.close()
+
+class SearchIndex:
+    """Local full-text index of decrypted messages, encrypted at rest. SQLite's
+    FTS5 would keep every word in plaintext, so instead each word (and its
+    prefixes, for 'term*' queries) is stored as a keyed HMAC token in a postings
+    table, and the messages themselves are sealed. An attacker with the file
+    and without your key learns only how many messages there are, their
+    Telegram message ids (kept in the clear so the newest matches can be
+    picked without opening every hit) and how often each (unknown) word occurs."""
+
+    def __init__(self, path, secret):
+        self.path = path
+        self.db, self.box = open_encrypted_db(path, secret)
+        self.db.executescript("""
+            CREATE TABLE IF NOT EXISTS docs (doc BLOB PRIMARY KEY, msg_id INTEGER NOT NULL, payload BLOB NOT NULL);
+            CREATE INDEX IF NOT EXISTS docs_msg_id ON docs (msg_id);
+            CREATE TABLE IF NOT EXISTS postings (token BLOB NOT NULL, doc BLOB NOT NULL,
+                PRIMARY KEY (token, doc)) WITHOUT ROWID;
+            CREATE INDEX IF NOT EXISTS postings_doc ON postings (doc);
+            CREATE TABLE IF NOT EXISTS backfill (chat BLOB PRIMARY KEY, payload BLOB NOT NULL);
+        """)
+        self.db.commit()
+
+    @staticmethod
+    def words(text):
+        return set(re.findall(r'\w+', text.lower()))
+
+    def token(self, kind, word):
+        return self.box.blind_id(kind, word)[:16]
+
+    def tokens_for(self, text):
+        tokens = set()
+        for word in self.words(text):
+            tokens.add(self.token('w', word))
+            for n in range(SEARCH_PREFIX_MIN, min(len(word), SEARCH_PREFIX_MAX) + 1):
+                tokens.add(self.token('p', word[:n]))
+        return tokens
+
+    def add_many(self, chat_id, peer_name, entries):
+        """entries: [(message id, date, outgoing, text)]. Re-adding a message replaces it (edits)."""
+        docs, postings = [], []
+        for msg_id, date, out, text in entries:
+            if not text:
+                continue
+            doc = self.box.blind_id('doc', chat_id, msg_id)
+            payload = json.dumps({"chat_id": chat_id, "id": msg_id, "peer": peer_name, "out": bool(out),
+                                  "date": date.timestamp() if date else 0, "text": text})
+            docs.append((doc, msg_id, self.box.seal(payload.encode('utf-8'))))
+            postings.extend((token, doc) for token in self.tokens_for(text))
+        if not docs:
+            return
+        with self.db:
+            self.db.executemany("DELETE FROM postings WHERE doc = ?", [(doc,) for doc, _, _ in docs])
+            self.db.executemany("INSERT OR REPLACE INTO docs (doc, msg_id, payload) VALUES (?, ?, ?)", docs)
+            self.db.executemany("INSERT OR IGNORE INTO postings (token, doc) VALUES (?, ?)", postings)
+        METRICS.count('search.indexed', len(docs))
+
+    def add(self, chat_id, peer_name, msg_id, date, out, text):
+        self.add_many(chat_id, peer_name, [(msg_id, date, out, text)])
+
+    def search(self, query, limit=SEARCH_RESULTS_LIMIT):
+        """Messages containing every term (a trailing * matches word prefixes), newest first."""
+        tokens = set()
+        for term in query.lower().split():
+            prefix = term.endswith('*')
+            for word in self.words(term):
+                if prefix and len(word) >= SEARCH_PREFIX_MIN:
+                    tokens.add(self.token('p', word[:SEARCH_PREFIX_MAX]))
+                else:
+                    tokens.add(self.token('w', word))
+        if not tokens:
+            return []
+        placeholders = ",".join("?" * len(tokens))
+        rows = self.db.execute(
+            f"""SELECT docs.payload FROM docs WHERE doc IN (
+                SELECT doc FROM postings WHERE token IN ({placeholders})
+                GROUP BY doc HAVING COUNT(*) = ?)
+            ORDER BY msg_id DESC LIMIT ?""", (*tokens, len(tokens), limit)).fetchall()
+        results = []
+        for (payload,) in rows:
+            try:
+                entry = json.loads(self.box.open(payload))
+            except ValueError:
+                continue
+            results.append(entry)
+        results.sort(key=lambda entry: entry['date'], reverse=True)
+        return results
+
+    def count(self):
+        return self.db.execute("SELECT COUNT(*) FROM docs").fetchone()[0]
+
+    def backfill_state(self, chat_id):
+        row = self.db.execute("SELECT payload FROM backfill WHERE chat = ?", (self.box.blind_id('backfill', chat_id),)).fetchone()
+        if row:
+            try:
+                return json.loads(self.box.open(row[0]))
+            except ValueError:
+                pass
+        return {"newest": 0, "oldest": 0, "done": False}
+
+    def save_backfill_state(self, chat_id, state):
+        with self.db:
+            self.db.execute("INSERT OR REPLACE INTO backfill (chat, payload) VALUES (?, ?)",
+                            (self.box.blind_id('backfill', chat_id), self.box.seal(json.dumps(state).encode('utf-8'))))
+
+    def close(self):
+        self.db.close()
+
+async def backfill_search_index(app, delay=DEFAULT_SEARCH_BACKFILL_DELAY):
+    """Walks the history of every open chat into the search index, one page per
+    `delay` seconds so it never competes with the chat for Telegram's rate limit.
+    Decrypting runs on pgp's single background worker, at most half busy.
+    Each chat first catches up on messages newer than the last run, then goes on
+    backwards from the oldest message indexed so far. Progress is saved per page."""
+    index = app.search_index
+    while True:
+        worked = False
+        for chat in list(app.sessions.values()):
+            try:
+                worked = await backfill_chat(app, index, chat, delay) or worked
+            except Exception:
+                # Offline, flood-limited, chat gone... try again on the next round
+                METRICS.count('search.backfill_errors')
+            await asyncio.sleep(delay)
+        if not worked:
+            await asyncio.sleep(SEARCH_BACKFILL_IDLE)
+
+async def backfill_chat(app, index, chat, delay):
+    """One backfill step for a chat. Returns True if anything was indexed."""
+    worked = False
+    chat_id = chat.entity.id
+    state = index.backfill_state(chat_id)
+    first_run = not state['newest']
+
+    # Catch up, newest page first, down to what the last run already saw.
+    # (On the first run just one page: the rest is the backwards walk.)
+    cursor = 0
+    newest = state['newest']
+    while True:
+        page = await app.transport.get_messages(chat.entity, limit=HISTORY_PAGE_SIZE,
+                                                offset_id=cursor, min_id=state['newest'])
+        if not page:
+            break
+        await index_history_page(app.pgp, app.message_cache, index, chat, page)
+        newest = max(newest, page[0].id)
+        if first_run:
+            state['oldest'] = page[-1].id
+        cursor = page[-1].id
+        worked = True
+        if first_run or len(page) < HISTORY_PAGE_SIZE:
+            break
+        await asyncio.sleep(delay)
+    state['newest'] = newest
+
+    if state['oldest'] and not state['done']:
+        page = await app.transport.get_messages(chat.entity, limit=HISTORY_PAGE_SIZE, offset_id=state['oldest'])
+        if page:
+            await index_history_page(app.pgp, app.message_cache, index, chat, page)
+            state['oldest'] = page[-1].id
+            worked = True
+        else:
+            state['done'] = True
+    index.save_backfill_state(chat_id, state)
+    return worked
+
+async def index_history_page(pgp, message_cache, search_index, chat, page):
+    # Off the chat's worker pool and paced by decrypt time, so a page of old
+    # messages cannot hold up new ones
+    decrypted_by_id = await decrypt_pgp_messages(pgp, message_cache, chat.entity.id, page,
+                                                 decrypt_many=pgp.decrypt_many_in_background)
+    add_history_to_index(search_index, chat, page, decrypted_by_id)
 
+def add_history_to_index(search_index, chat, messages, decrypted_by_id):
+    entries = []
+    for message in messages:
+        if message.file or not message.text:
+            continue
+        text = decrypted_by_id.get(message.id, message.text)
+        if text is None or "DECRYPTION_FAILED" in text or is_encrypted_text(text):
+            continue
+        entries.append((message.id, message.date, message.out, text))
+    search_index.add_many(chat.entity.id, chat.entity.first_name, entries)
+
+# --- Rendering ---
+# Chat lines are lists of (style, text) fragments rather than HTML() markup: building
+# them is a few tuple allocations, while HTML() runs an XML parser for every line.
+@functools.lru_cache(maxsize=1024)
+def sender_label(time_str, name):
+    """'[12:00] [Alice]' (name None = You). Cached, since a burst repeats the same few."""
+    return f"[{time_str}] [{'You' if name is None else name}]"
+
+def chat_line(tag, text, content=()):
+    """Fragments for <tag>text<inner>...</inner></tag>; content is (inner tag or '', text) pairs."""
+    outer = f"class:{tag}"
+    line = [(outer, text)]
+    for inner, inner_text in content:
+        line.append((f"{outer},{inner}" if inner else outer, inner_text))
+    return line
+
+class Renderer:
+    """Prints chat lines in batches: lines added within one frame (`interval`
+    seconds) go out as a single write and a single prompt redraw, instead of one
+    erase/print/redraw cycle per line. An isolated line is printed on the next
+    loop iteration, so batching only adds delay during a burst."""
+
+    def __init__(self, interval=DEFAULT_RENDER_INTERVAL_MS / 1000):
+        self.interval = interval
+        self.lines = []
+        self.callbacks = [] # Called once the batch holding their line has been printed
+        self.flush_handle = None
+        self.last_flush = 0.0
+        # print_formatted_text() merges the default UI style into ours and compiles the
+        # result again on every call; done once here, the compiled rules stay cached.
+        self.style = merge_styles([default_ui_style(), style])
+
+    def add(self, line, on_shown=None):
+        """Queues one line (chat_line() fragments) for the next frame."""
+        self.lines.append(line)
+        if on_shown:
+            self.callbacks.append(on_shown)
+        if self.flush_handle is None:
+            loop = asyncio.get_running_loop()
+            delay = self.last_flush + self.interval - time.monotonic()
+            self.flush_handle = loop.call_later(delay, self.flush) if delay > 0 else loop.call_soon(self.flush)
+
+    def flush(self):
+        """Prints everything queued so far. Call before printing directly, to keep the order."""
+        if self.flush_handle:
+            self.flush_handle.cancel()
+            self.flush_handle = None
+        if not self.lines:
+            return
+        lines, self.lines = self.lines, []
+        callbacks, self.callbacks = self.callbacks, []
+        self.last_flush = time.monotonic()
+        METRICS.count('render.lines', len(lines))
+
+        fragments = []
+        for line in lines:
+            fragments.extend(to_formatted_text(line))
+            fragments.append(('', '\n'))
+        output = get_app_session().output
+
+        def render():
+            with METRICS.timed('render.flush'):
+                render_fragments(output, fragments, self.style, color_depth=output.get_default_color_depth())
+                output.flush()
+            for callback in callbacks:
+                callback()
+
+        if get_app_or_none() is not None:
+            # The prompt is up: erase it, print the batch, draw it again (once)
+            run_in_terminal(render)
+        else:
+            render()
+
+RENDERER = Renderer()
+
+# --- History ---
+def parse_history_args(args):
+    """/history [n] [--since YYYY-MM-DD[THH:MM]] [--offset <message id>]
+    Returns (limit, since, offset_id). limit is None for "everything since"."""
+    limit = None
+    since = None
+    offset_id = 0
+    i = 0
+    while i < len(args):
+        arg = args[i]
+        if arg == '--since' and i + 1 < len(args):
+            since = datetime.fromisoformat(args[i + 1]).astimezone()
+            i += 2
+        elif arg == '--offset' and i + 1 < len(args):
+            offset_id = int(args[i + 1])
+            i += 2
+        elif arg.isdigit():
+            limit = int(arg)
+            i += 1
+        else:
+            raise ValueError(f"unexpected argument '{arg}'")
+    if limit is None and since is None:
+        limit = DEFAULT_HISTORY_LIMIT
+    return limit, since, offset_id
+
+async def decrypt_pgp_messages(pgp, message_cache, chat_id, messages, decrypt_many=None):
+    """Returns {message id: plaintext or DECRYPTION_FAILED} for the encrypted
+    messages in `messages`. A multipart compact message is decrypted once, under
+    the id of the part that completed it; its other parts map to None. Parts of
+    a message that is not complete in `messages` are left out. Cache hits are
+    served from disk; the rest are decrypted with `decrypt_many` (default: concurrently
+    on the worker pool, pgp.decrypt_many) and added to the cache."""
+    encrypted = [] # (message, encrypted text)
+    decrypted_by_id = {}
+    assembler = CompactAssembler()
+    for m in messages:
+        if m.file or not m.text:
+            continue
+        part = parse_compact(m.text)
+        if part is not None and part[2] > 1:
+            assembled = assembler.add(chat_id, m.id, part)
+            if assembled:
+                text, part_ids = assembled
+                decrypted_by_id.update(dict.fromkeys(part_ids))
+                encrypted.append((m, text))
+        elif part is not None or "BEGIN PGP MESSAGE" in m.text:
+            encrypted.append((m, m.text))
+
+    hits = {}
+    if message_cache:
+        hits = message_cache.get_many(chat_id, [(m.id, m.edit_date) for m, _ in encrypted])
+    decrypted_by_id.update(hits)
+    to_decrypt = [(m, text) for m, text in encrypted if m.id not in hits]
+    decrypted_results = await (decrypt_many or pgp.decrypt_many)([text for _, text in to_decrypt])
+    decrypted_by_id.update({m.id: d for (m, _), d in zip(to_decrypt, decrypted_results)})
+    if message_cache:
+        message_cache.put_many(chat_id, [(m.id, m.edit_date, d) for (m, _), d in zip(to_decrypt, decrypted_results)
+                                         if "DECRYPTION_FAILED" not in d])
+    return decrypted_by_id
+
+def split_page_for_compact(page):
+    """Splits a history page before the first part of any multipart compact message
+    whose last part has not arrived yet, so the parts end up in the same page."""
+    open_groups = {} # group -> position of its first part in the page
+    for position, message in enumerate(page):
+        part = parse_compact(message.text) if message.text and not message.file else None
+        if part is not None and part[2] > 1:
+            group, index, count, _ = part
+            if index == count:
+                open_groups.pop(group, None)
+            else:
+                open_groups.setdefault(group, position)
+    cut = min(open_groups.values(), default=0)
+    if cut == 0: # Nothing to hold back, or the whole page would be
+        return page, []
+    return page[:cut], page[cut:]
+
+def message_file_name(message):
+    file_name = "file"
+    # Check if 'document' exists and has 'attributes' before accessing
+    if hasattr(message.file, 'name') and message.file.name:
+        file_name = message.file.name
+    elif message.document and hasattr(message.document, 'attributes'):
+        for attr in message.document.attributes:
+            if hasattr(attr, 'file_name') and attr.file_name:
+                file_name = attr.file_name
+    return file_name
+
+def format_file_content(message):
+    """(inner tag, text) content pair for a file message, see chat_line()."""
+    file_name = message_file_name(message)
+    if file_name.endswith(ENCRYPTED_FILE_SUFFIX):
+        return ('info', f"🔒 [{file_name[:-len(ENCRYPTED_FILE_SUFFIX)]}] /getfile {message.id}")
+    return ('', f"[{file_name}]")
+
+def format_history_line(message, decrypted_by_id, peer_name):
+    time_str = message.date.astimezone().strftime('%H:%M')
+    label = sender_label(time_str, None if message.out else peer_name)
+    content = ('', "")
+
+    if message.file:
+        content = format_file_content(message)
+
+    elif message.text:
+        if is_encrypted_text(message.text):
+            if message.id not in decrypted_by_id:
+                return chat_line('error', f"{label}: 🔒 [Part of a longer message; the rest is outside this range]")
+            decrypted = decrypted_by_id[message.id]
+            if decrypted is None:
+                return None # Part of a multipart message, shown once all parts are in
+            if "DECRYPTION_FAILED" in decrypted:
+                content = ('error', "🔒 [PGP Error]")
+            else:
+                content = ('info', str(decrypted))
+        else:
+            content = ('', str(message.text))
+
+    elif message.action:
+        # New check for Calls
+        if "PhoneCall" in type(message.action).__name__:
+            content = ('', "[Call]")
+
+    return chat_line('sent' if message.out else 'user', f"{label}: ", [content])
+
+async def stream_history(client, pgp, message_cache, chat, limit, since=None, offset_id=0, search_index=None):
+    """Prints history oldest-first as soon as each page is fetched and decrypted.
+    Fetching, decrypting and printing overlap, with at most
+    HISTORY_PAGES_IN_FLIGHT pages held in memory. Returns (printed, oldest id)."""
+    if since is not None:
+        messages = client.iter_messages(chat.entity, limit=limit, offset_date=since, reverse=True, max_id=offset_id)
+    else:
+        # One tiny request finds the oldest message of the range, then we walk
+        # forward from it so pages arrive in the order they are printed.
+        anchor = await client.get_messages(chat.entity, limit=1, offset_id=offset_id, add_offset=limit - 1)
+        start_after = anchor[0].id - 1 if anchor else 0
+        messages = client.iter_messages(chat.entity, limit=limit, reverse=True, offset_id=start_after, max_id=offset_id)
+
+    pages = asyncio.Queue()
+    page_slots = asyncio.Semaphore(HISTORY_PAGES_IN_FLIGHT)
+
+    async def prepare_page(page):
+        with METRICS.timed('history.page_decrypt'):
+            decrypted_by_id = await decrypt_pgp_messages(pgp, message_cache, chat.entity.id, page)
+        if search_index:
+            add_history_to_index(search_index, chat, page, decrypted_by_id)
+        return page, decrypted_by_id
+
+    async def produce():
+        try:
+            page = []
+            page_started = time.perf_counter()
+            async for message in messages:
+                page.append(message)
+                if len(page) == HISTORY_PAGE_SIZE:
+                    # Time to pull one page out of Telegram (network-bound part)
+                    METRICS.record('history.page_fetch', time.perf_counter() - page_started)
+                    # Unfinished multipart messages carry over into the next page
+                    ready, page = split_page_for_compact(page)
+                    await page_slots.acquire()
+                    pages.put_nowait(asyncio.ensure_future(prepare_page(ready)))
+                    page_started = time.perf_counter()
+            if page:
+                METRICS.record('history.page_fetch', time.perf_counter() - page_started)
+                await page_slots.acquire()
+                pages.put_nowait(asyncio.ensure_future(prepare_page(page)))
+        finally:
+            pages.put_nowait(None)
+
+    producer = asyncio.ensure_future(produce())
+    printed = 0
+    oldest_id = None
     try:
-        initial_entity = await client.get_entity(target_user)
-        print_formatted_text(HTML(f"<system>--- Chatting with {initial_entity.first_name} ---</system>"), style=style)
-        current_chat = ChatSession(initial_entity)
-    except Exception as e:
-        print_formatted_text(HTML(f"<error>❌ Connection error: Could not find user '{target_user}'. Error: {e}</error>"), style=style)
-        print_formatted_text(HTML(f"<error>Please check the username and restart, or use /recipient to switch.</error>"), style=style)
+        while True:
+            pending_page = await pages.get()
+            if pending_page is None:
+                break
+            page, decrypted_by_id = await pending_page
+            for message in page:
+                line = format_history_line(message, decrypted_by_id, chat.entity.first_name)
+                if line is not None:
+                    RENDERER.add(line)
+            printed += len(page)
+            if oldest_id is None:
+                oldest_id = page[0].id
+            page_slots.release()
+        await producer # Re-raises fetch errors
+    finally:
+        RENDERER.flush() # Before the caller prints its footer
+        producer.cancel()
+        while not pages.empty():
+            pending_page = pages.get_nowait()
+            if pending_page is not None:
+                pending_page.cancel()
+    return printed, oldest_id
 
-    # --- CHAT PHASE ---
-    session = PromptSession()
+# --- Transports ---
+class RetryAfter(Exception):
+    """Raised by a transport when the server asks us to wait before sending again."""
+    def __init__(self, seconds):
+        super().__init__(f"rate limited for {seconds} s")
+        self.seconds = seconds
+
+class TelegramTransport:
+    """SilentGram's view of Telegram: the few TelegramClient calls the app makes,
+    plus handler registration. ReplayTransport offers the same methods offline."""
+
+    def __init__(self, api_id, api_hash):
+        from telethon import TelegramClient, events, types, errors
+        self.events = events
+        self.types = types
+        self.errors = errors
+        self.client = TelegramClient(SESSION_FILE, api_id, api_hash)
+        # What Telegram answers when a cached id/access_hash is no longer valid for us
+        self.stale_peer_errors = (errors.PeerIdInvalidError, errors.UserIdInvalidError)
+        self.entities = {} # normalized username -> entity, resolved this run
+        self.account_id = None
+        self.cache_account_id, self.entity_cache = self.load_entity_cache()
+
+    @staticmethod
+    def load_entity_cache():
+        """(account id, entries) from ENTITY_CACHE_FILE; access hashes only hold for that account."""
+        try:
+            with open(ENTITY_CACHE_FILE, 'r') as f:
+                data = json.load(f)
+            return data['account_id'], data['entities']
+        except (OSError, json.JSONDecodeError, KeyError, TypeError):
+            return None, {}
+
+    def save_entity_cache(self):
+        try:
+            with open(ENTITY_CACHE_FILE, 'w') as f:
+                json.dump({'account_id': self.account_id, 'entities': self.entity_cache}, f, indent=4)
+        except OSError:
+            pass # Only a start-up shortcut; next start resolves again
+
+    async def start(self):
+        await self.client.start()
+        # Known after start() (it calls get_me), so this costs no request
+        me = await self.client.get_me(input_peer=True)
+        self.account_id = me.user_id
+        if self.cache_account_id != self.account_id:
+            # Written by another account (or an old version): none of it is usable
+            self.entity_cache = {}
+            if os.path.exists(ENTITY_CACHE_FILE):
+                self.save_entity_cache()
+
+    async def disconnect(self):
+        await self.client.disconnect()
+
+    async def get_entity(self, username):
+        key = normalize_username(username)
+        entity = self.entities.get(key)
+        if entity is not None:
+            return entity
+        cached = self.entity_cache.get(key)
+        if cached:
+            # id + access_hash is all Telegram needs to address a user, so a
+            # known username costs no request at all
+            entity = self.types.User(id=cached['id'], access_hash=cached['access_hash'],
+                                     first_name=cached.get('first_name'), username=cached.get('username'))
+            METRICS.count('telegram.entity_cache_hits')
+        else:
+            with METRICS.timed('telegram.get_entity'):
+                entity = await self.client.get_entity(username)
+            if isinstance(entity, self.types.User) and entity.access_hash is not None:
+                self.entity_cache[key] = {
+                    'id': entity.id,
+                    'access_hash': entity.access_hash,
+                    'first_name': entity.first_name,
+                    'username': entity.username,
+                }
+                self.save_entity_cache()
+        self.entities[key] = entity
+        return entity
+
+    async def refresh_entity(self, entity):
+        """Telegram rejected `entity`: drops it from the cache and resolves its username
+        again. The entity is updated in place, so ChatSessions holding it keep working.
+        Returns False if it cannot be resolved this way."""
+        keys = [key for key, cached in self.entity_cache.items() if cached['id'] == entity.id]
+        if not keys:
+            return False # Not from our cache, so a fresh lookup would not help
+        for key in keys:
+            del self.entity_cache[key]
+            self.entities.pop(key, None)
+        self.save_entity_cache()
+        METRICS.count('telegram.entity_cache_stale')
+        fresh = await self.get_entity(entity.username or keys[0])
+        entity.access_hash = fresh.access_hash
+        return True
+
+    async def with_entity(self, call, entity, *args, **kwargs):
+        """Runs call(entity, ...), re-resolving a stale cached entity once."""
+        try:
+            return await call(entity, *args, **kwargs)
+        except self.stale_peer_errors:
+            if not await self.refresh_entity(entity):
+                raise
+            return await call(entity, *args, **kwargs)
+
+    async def send_message(self, entity, text):
+        with METRICS.timed('telegram.send_message'):
+            try:
+                return await self.with_entity(self.client.send_message, entity, text)
+            except self.errors.FloodWaitError as e:
+                raise RetryAfter(e.seconds) from e
+
+    async def get_messages(self, entity, **kwargs):
+        with METRICS.timed('telegram.get_messages'):
+            return await self.with_entity(self.client.get_messages, entity, **kwargs)
+
+    async def iter_messages(self, entity, **kwargs):
+        started = False
+        try:
+            async for message in self.client.iter_messages(entity, **kwargs):
+                started = True
+                yield message
+        except self.stale_peer_errors:
+            # Only the first request can fail this way; restart it with the fresh entity
+            if started or not await self.refresh_entity(entity):
+                raise
+            async for message in self.client.iter_messages(entity, **kwargs):
+                yield message
+
+    async def send_file(self, entity, path, caption, progress_callback=None):
+        # Telethon uploads from the path part by part; the file is never read whole
+        with METRICS.timed('telegram.send_file'):
+            try:
+                return await self.with_entity(self.client.send_file, entity, path, caption=caption, force_document=True,
+                                              progress_callback=progress_callback)
+            except self.errors.FloodWaitError as e:
+                raise RetryAfter(e.seconds) from e
+
+    async def download_media(self, message, path, progress_callback=None):
+        with METRICS.timed('telegram.download_media'):
+            return await self.client.download_media(message, file=path, progress_callback=progress_callback)
+
+    def watch_chats(self, callback, entities):
+        # Telegram pushes every update of the account; there is no server-side
+        # subscription per chat. Registering with chats= makes Telethon's
+        # dispatcher drop other chats before our callback (and its
+        # patch_stdout/redraw) ever runs.
+        self.client.remove_event_handler(callback)
+        if entities:
+            self.client.add_event_handler(callback, self.events.NewMessage(chats=list(entities)))
+
+    def watch_message_updates(self, callback):
+        """callback(private) for every new-message update of the account, before chat filtering."""
+        types = self.types
+
+        async def count_message_update(update):
+            private = not (isinstance(update, (types.UpdateNewChannelMessage, types.UpdateShortChatMessage)) or (
+                isinstance(update, types.UpdateNewMessage) and not isinstance(update.message.peer_id, types.PeerUser)))
+            callback(private)
 
-    @client.on(events.NewMessage())
-    async def handler(event):
-        if not current_chat or event.chat_id != current_chat.entity.id:
+        self.client.add_event_handler(count_message_update, self.events.Raw(types=[
+            types.UpdateNewMessage, types.UpdateShortMessage,
+            types.UpdateNewChannelMessage, types.UpdateShortChatMessage,
+        ]))
+
+class ReplayEntity:
+    def __init__(self, entity_id, username):
+        self.id = entity_id
+        self.username = username
+        self.first_name = username
+
+class ReplayMessage:
+    def __init__(self, message_id, text, out, date):
+        self.id = message_id
+        self.text = text
+        self.raw_text = text
+        self.out = out
+        self.date = date
+        self.edit_date = None
+        self.file = None
+        self.document = None
+        self.action = None
+
+class ReplayEvent:
+    def __init__(self, chat_id, message):
+        self.chat_id = chat_id
+        self.message = message
+        self.raw_text = message.raw_text
+        self.out = message.out
+        self.date = message.date
+        self.received_at = time.perf_counter()
+
+class ReplayTransport:
+    """Offline stand-in for TelegramTransport. Messages come from a JSONL stream
+    (one object per line):
+
+        {"chat": "@alice", "text": "hi or a PGP block", "out": false, "at": 0.25}
+        {"send": "typed by the user"}
+
+    "at" is seconds from the start (optional). "send" lines go through the app's
+    send path; the resulting send_message calls are captured in `sent`."""
+
+    def __init__(self):
+        self.entities = {} # normalized username -> ReplayEntity
+        self.message_callback = None
+        self.watched_ids = set()
+        self.update_callback = None
+        self.sent = []
+        self.next_message_id = 1
+
+    @staticmethod
+    def load(path):
+        with open(path, 'r') as f:
+            return [json.loads(line) for line in f if line.strip()]
+
+    async def start(self):
+        pass
+
+    async def disconnect(self):
+        pass
+
+    async def get_entity(self, username):
+        key = normalize_username(username)
+        if key not in self.entities:
+            self.entities[key] = ReplayEntity(1000 + len(self.entities), key)
+        return self.entities[key]
+
+    def new_message(self, text, out):
+        message = ReplayMessage(self.next_message_id, text, out, datetime.now().astimezone())
+        self.next_message_id += 1
+        return message
+
+    async def send_message(self, entity, text):
+        message = self.new_message(text, True)
+        self.sent.append({"chat_id": entity.id, "id": message.id, "text": text})
+        return message
+
+    async def get_messages(self, entity, **kwargs):
+        return None if 'ids' in kwargs else []
+
+    async def send_file(self, entity, path, caption, progress_callback=None):
+        message = self.new_message(caption, True)
+        self.sent.append({"chat_id": entity.id, "id": message.id, "file": os.path.basename(path),
+                          "bytes": os.path.getsize(path)})
+        return message
+
+    async def download_media(self, message, path, progress_callback=None):
+        raise RuntimeError("Replay streams have no media to download")
+
+    async def iter_messages(self, entity, **kwargs):
+        return
+        yield
+
+    def watch_chats(self, callback, entities):
+        self.message_callback = callback
+        self.watched_ids = {entity.id for entity in entities}
+
+    def watch_message_updates(self, callback):
+        self.update_callback = callback
+
+    async def deliver(self, record):
+        """Feeds one stream record through the same filtering as Telethon would."""
+        entity = await self.get_entity(record.get('chat', '@replay'))
+        event = ReplayEvent(entity.id, self.new_message(record.get('text', ''), bool(record.get('out', False))))
+        if self.update_callback:
+            self.update_callback(True)
+        if self.message_callback and entity.id in self.watched_ids:
+            await self.message_callback(event)
+
+# --- File Transfer ---
+class TransferProgress:
+    """Progress callback (current, total) printing a line every PROGRESS_STEP percent.
+    May be called from worker threads; printing always happens on the event loop."""
+
+    def __init__(self, label, loop):
+        self.label = label
+        self.loop = loop
+        self.next_percent = PROGRESS_STEP
+
+    def __call__(self, current, total):
+        if not total:
             return
+        percent = current * 100 // total
+        if percent < self.next_percent:
+            return
+        self.next_percent = (percent // PROGRESS_STEP + 1) * PROGRESS_STEP
+        self.loop.call_soon_threadsafe(self.print_line, percent, total)
 
-        with patch_stdout():
-            raw_text = event.raw_text
-            # Get local time from event
-            time_str = event.date.astimezone().strftime('%H:%M')
-            
-            if "BEGIN PGP MESSAGE" in raw_text:
-                decrypted = pgp.decrypt(raw_text)
+    def print_line(self, percent, total):
+        RENDERER.add(chat_line('system', f"{self.label}: {min(percent, 100)}% of {format_size(total)}"))
+
+class ProgressReader:
+    """Wraps a binary file object and reports how much of it has been read."""
+
+    def __init__(self, fileobj, total, callback):
+        self.fileobj = fileobj
+        self.total = total
+        self.callback = callback
+        self.done = 0
+
+    def read(self, size=-1):
+        data = self.fileobj.read(size)
+        self.done += len(data)
+        self.callback(self.done, self.total)
+        return data
+
+def format_size(size):
+    for unit in ('B', 'KB', 'MB', 'GB'):
+        if size < 1024 or unit == 'GB':
+            return f"{size:.0f} {unit}" if unit == 'B' else f"{size:.1f} {unit}"
+        size /= 1024
+
+def safe_file_name(name):
+    """Bare file name from a sender-chosen name: no directories, no '..'."""
+    name = os.path.basename(name.replace('\\', '/'))
+    if name in ('', '.', '..'):
+        return "file"
+    return name
+
+def unique_path(directory, name):
+    """directory/name, or 'name (n).ext' if that file already exists."""
+    base, ext = os.path.splitext(name)
+    path = os.path.join(directory, name)
+    n = 1
+    while os.path.exists(path):
+        path = os.path.join(directory, f"{base} ({n}){ext}")
+        n += 1
+    return path
+
+# --- Send Queue ---
+class OutgoingMessage:
+    def __init__(self, chat, text, encrypted, deadline):
+        self.chat = chat
+        self.texts = [text]
+        self.encrypted = encrypted
+        self.deadline = deadline # loop time until which more lines may be coalesced
+        self.ciphertext = None   # Future, started at enqueue when not coalescing
+        self.queued_at = time.perf_counter()
+        self.time_str = datetime.now().strftime('%H:%M')
+
+    @property
+    def text(self):
+        return "\n".join(self.texts)
+
+class SendQueue:
+    """Outgoing messages, sent in order by one background task so the prompt never
+    waits on gpg or the network. Encryption starts in the worker pool as soon as
+    a line is queued, so it overlaps with the send of the line before it.
+    With a coalesce window, lines typed to the same chat within the window go out
+    as one message (encrypted once the window closes)."""
+
+    def __init__(self, pgp, transport, message_cache=None, coalesce_window=0):
+        self.pgp = pgp
+        self.transport = transport
+        self.message_cache = message_cache
+        self.coalesce_window = coalesce_window
+        self.queue = asyncio.Queue()
+        self.open_item = None
+        self.pending = 0 # Messages queued or being sent
+        self.worker = None
+        self.current_chat = lambda: None # Set by the app; used to label lines for background chats
+        self.on_sent = None # Optional hook(chat, sent message, plaintext)
+
+    def __len__(self):
+        return self.pending
+
+    def enqueue(self, chat, text, encrypted):
+        loop = asyncio.get_running_loop()
+        item = self.open_item
+        if (item and item.chat is chat and item.encrypted == encrypted and loop.time() < item.deadline):
+            item.texts.append(text)
+            METRICS.count('send.coalesced')
+            return
+        item = OutgoingMessage(chat, text, encrypted, loop.time() + self.coalesce_window)
+        if self.coalesce_window:
+            self.open_item = item
+        elif encrypted:
+            item.ciphertext = asyncio.ensure_future(self.pgp.encrypt_for_wire_async(text, chat.fingerprint))
+        self.pending += 1
+        self.queue.put_nowait(item)
+        if self.worker is None or self.worker.done():
+            self.worker = asyncio.ensure_future(self.run())
+
+    async def run(self):
+        while True:
+            item = await self.queue.get()
+            try:
+                await self.deliver(item)
+            except Exception as e:
+                self.report(chat_line('error', f"❌ Not sent: {e}"))
+            finally:
+                self.pending -= 1
+                self.queue.task_done()
+
+    async def deliver(self, item):
+        delay = item.deadline - asyncio.get_running_loop().time()
+        if delay > 0:
+            await asyncio.sleep(delay)
+        if self.open_item is item:
+            self.open_item = None
+
+        payloads = [item.text]
+        if item.encrypted:
+            if item.ciphertext is None:
+                item.ciphertext = asyncio.ensure_future(self.pgp.encrypt_for_wire_async(item.text, item.chat.fingerprint))
+            payloads = await item.ciphertext
+            if payloads[0].startswith("[Encryption Error"):
+                # e.g. a contacts fingerprint that is not in the keyring
+                METRICS.count('send.failed')
+                self.report(chat_line('error', f"❌ Not sent: {payloads[0]}"))
+                return
+
+        # Long compact messages go out as several parts, in order
+        for i, payload in enumerate(payloads, 1):
+            sent_msg = await self.send_with_retry(item, payload)
+            if sent_msg is None:
+                if i > 1:
+                    self.report(chat_line('error', f"⚠️ Only {i - 1} of {len(payloads)} parts were sent."))
+                return
+
+        METRICS.record('send.queued_to_sent', time.perf_counter() - item.queued_at)
+        if self.on_sent:
+            self.on_sent(item.chat, sent_msg, item.text)
+        label = sender_label(item.time_str, None) + self.chat_label(item)
+        if item.encrypted:
+            if self.message_cache:
+                # Encrypted to the recipient, so we could not decrypt it ourselves later
+                self.message_cache.put(item.chat.entity.id, sent_msg.id, sent_msg.edit_date, item.text)
+            self.report(chat_line('sent', f"{label} encrypted: {item.text}"))
+        else:
+            self.report(chat_line('plain', f"{label}: {item.text}"))
+
+    async def send_with_retry(self, item, payload):
+        """Sends one Telegram message, retrying flood waits and network errors. None if it failed."""
+        for attempt in range(SEND_MAX_RETRIES + 1):
+            try:
+                return await self.transport.send_message(item.chat.entity, payload)
+            except (RetryAfter, ConnectionError, OSError) as e:
+                if attempt == SEND_MAX_RETRIES:
+                    METRICS.count('send.failed')
+                    self.report(chat_line('error', f"❌ Not sent after {attempt + 1} attempts: {e}"))
+                    return None
+                wait = e.seconds if isinstance(e, RetryAfter) else SEND_RETRY_BASE_DELAY * 2 ** attempt
+                METRICS.count('send.retries')
+                self.report(chat_line('system', f"⏳ Telegram asked to slow down; retrying in {wait:.0f} s ({len(self) - 1} more queued)"
+                                      if isinstance(e, RetryAfter) else
+                                      f"⏳ Send failed ({e}); retrying in {wait:.0f} s"))
+                await asyncio.sleep(wait)
+
+    def chat_label(self, item):
+        if item.chat is self.current_chat():
+            return ""
+        return f" → {item.chat.entity.first_name or ''}"
+
+    def report(self, line):
+        RENDERER.add(line)
+
+    async def drain(self, timeout=SEND_DRAIN_TIMEOUT):
+        """Waits for queued messages to go out. Returns how many are still unsent."""
+        if self.pending:
+            try:
+                await asyncio.wait_for(self.queue.join(), timeout)
+            except asyncio.TimeoutError:
+                pass
+        if self.worker:
+            self.worker.cancel()
+        return self.pending
+
+# --- Application ---
+class SilentGramApp:
+    def __init__(self, pgp, transport, message_cache=None, search_index=None):
+        self.pgp = pgp
+        self.transport = transport
+        self.message_cache = message_cache
+        self.search_index = search_index
+        self.current_chat = None
+        self.sessions = {}             # chat id -> ChatSession, all receiving at once
+        self.sessions_by_username = {} # normalized username -> ChatSession
+        self.encryption_enabled = True
+        self.event_counts = {'received': 0, 'handled': 0, 'non_private': 0}
+        self.decrypt_batcher = DecryptBatcher(pgp)
+        self.compact_assembler = CompactAssembler()
+        self.send_queue = SendQueue(pgp, transport, message_cache, pgp.coalesce_window_ms / 1000)
+        self.send_queue.current_chat = lambda: self.current_chat
+        if search_index:
+            self.send_queue.on_sent = lambda chat, sent_msg, text: search_index.add(
+                chat.entity.id, chat.entity.first_name, sent_msg.id, sent_msg.date, True, text)
+        self.on_rendered = None # Optional hook(event), called once a message's line has been printed (its batch flushed)
+        self.on_buffered = None # Optional hook(event), called when a message's line is kept for a background chat
+        self.transfers = set()  # Running /sendfile and /getfile tasks
+        self.prompt_session = None
+
+        self.transport.watch_message_updates(self.count_message_update)
+
+    def count_message_update(self, private):
+        self.event_counts['received'] += 1
+        if not private:
+            self.event_counts['non_private'] += 1
+        METRICS.count('updates.received')
+
+    def watch_chats(self):
+        self.transport.watch_chats(self.handle_new_message, [chat.entity for chat in self.sessions.values()])
+
+    async def open_chat(self, username, fingerprint=None):
+        """Returns the ChatSession for a username, opening (and watching) it if needed.
+        A new session encrypts to `fingerprint`, else pgp.fingerprint_for(username)."""
+        chat = self.sessions_by_username.get(normalize_username(username))
+        if chat:
+            return chat
+        entity = await self.transport.get_entity(username)
+        chat = self.sessions.get(entity.id) or ChatSession(entity, fingerprint or self.pgp.fingerprint_for(username))
+        self.sessions_by_username[normalize_username(username)] = chat
+        if entity.id not in self.sessions:
+            self.sessions[entity.id] = chat
+            self.watch_chats()
+            if not chat.fingerprint:
+                RENDERER.add(chat_line('error', f"⚠️ No public key for {username}: encrypted messages to this chat are refused. "
+                                                f"Add them to 'contacts' in {KEYS_FILE}, or use /eof to send plain text."))
+        return chat
+
+    def switch_chat(self, chat):
+        self.current_chat = chat
+        if chat.buffer:
+            RENDERER.add(chat_line('system', f"--- {chat.unread} new while away ---"))
+            for line in chat.buffer:
+                RENDERER.add(line)
+            chat.buffer.clear()
+        chat.unread = 0
+
+    async def handle_new_message(self, event):
+        chat = self.sessions.get(event.chat_id)
+        if not chat:
+            return
+        self.event_counts['handled'] += 1
+        METRICS.count('updates.handled')
+
+        # Telethon handles every update in its own task, so a plain message could
+        # overtake an encrypted one still decrypting. Each message's line waits for
+        # the line of the message before it in the same chat.
+        previous, done = chat.last_line, asyncio.get_running_loop().create_future()
+        chat.last_line = done
+        try:
+            line = await self.format_new_message(chat, event)
+            if previous is not None:
+                await asyncio.shield(previous) # Our cancellation must not cancel theirs
+            self.show_new_message(chat, event, line)
+        finally:
+            if not done.done():
+                done.set_result(None)
+            if chat.last_line is done:
+                chat.last_line = None
+
+    async def format_new_message(self, chat, event):
+        """The chat line for a new message, or None (e.g. one part of a longer one)."""
+        raw_text = event.raw_text
+        # Get local time from event
+        time_str = event.date.astimezone().strftime('%H:%M')
+        label = sender_label(time_str, None if event.out else chat.entity.first_name)
+        line = None
+        
+        if event.message.file:
+            line = chat_line('plain', f"{label}: ", [format_file_content(event.message)])
+
+        elif is_encrypted_text(raw_text):
+            part = parse_compact(raw_text)
+            if part is not None and part[2] > 1:
+                assembled = self.compact_assembler.add(event.chat_id, event.message.id, part)
+                raw_text = assembled[0] if assembled else None # None: more parts to come
+            if raw_text is not None:
+                decrypted = await self.decrypt_batcher.decrypt(raw_text)
                 if "DECRYPTION_FAILED" in decrypted:
                     if not event.out:
-                        label = f"[{time_str}] [{current_chat.entity.first_name}]"
-                        safe_err = html.escape(str(decrypted))
-                        print_formatted_text(HTML(f"<error>{label} 🔒 Error: {safe_err}</error>"), style=style)
+                        line = chat_line('error', f"{label} 🔒 Error: {decrypted}")
                 else:
-                    safe_decrypted = html.escape(str(decrypted))
+                    if self.message_cache:
+                        self.message_cache.put(event.chat_id, event.message.id, event.message.edit_date, decrypted)
+                    if self.search_index:
+                        self.search_index.add(event.chat_id, chat.entity.first_name, event.message.id, event.date, event.out, decrypted)
                     if event.out:
-                        print_formatted_text(HTML(f"<sent>[{time_str}] [You] verified: {safe_decrypted}</sent>"), style=style)
+                        line = chat_line('sent', f"{label} verified: {decrypted}")
                     else:
-                        print_formatted_text(HTML(f"<user>[{time_str}] [{current_chat.entity.first_name}] decrypted: {safe_decrypted}</user>"), style=style)
-            else:
-                label = f"[{time_str}] [You]" if event.out else f"[{time_str}] [{current_chat.entity.first_name}]"
-                safe_raw = html.escape(str(raw_text))
-                print_formatted_text(HTML(f"<plain>{label}: {safe_raw}</plain>"), style=style)
+                        line = chat_line('user', f"{label} decrypted: {decrypted}")
+        else:
+            line = chat_line('plain', f"{label}: {raw_text}")
+            if self.search_index and raw_text:
+                self.search_index.add(event.chat_id, chat.entity.first_name, event.message.id, event.date, event.out, raw_text)
+        return line
 
-    print("Use /help to see the list of commands and /exit to quit.")
-    
-    while True:
+    def show_new_message(self, chat, event, line):
+        if line is None:
+            return
+        if chat is self.current_chat:
+            RENDERER.add(line, functools.partial(self.on_rendered, event) if self.on_rendered else None)
+            return
+        chat.buffer.append(line)
+        chat.unread += 1
+        if chat.unread == 1:
+            RENDERER.add(chat_line('system', f"📨 New message from {chat.entity.first_name or ''} (/r to switch, /chats to list)"))
+        if self.on_buffered:
+            self.on_buffered(event)
+
+    def send_text(self, msg_clean):
+        """Queues a line for the current chat; status is printed when it has been sent."""
+        if not self.current_chat:
+            print_formatted_text(HTML(f"<error>❌ No recipient selected! Use /r to set one.</error>"), style=style)
+            return
+        if self.encryption_enabled and not self.current_chat.fingerprint:
+            print_formatted_text(HTML(f"<error>❌ Not sent: no public key for this chat. Add it to 'contacts' in {KEYS_FILE}, or use /eof to send plain text.</error>"), style=style)
+            return
+        self.send_queue.enqueue(self.current_chat, msg_clean, self.encryption_enabled)
+
+    def start_transfer(self, coroutine):
+        task = asyncio.ensure_future(coroutine)
+        self.transfers.add(task)
+        task.add_done_callback(self.transfers.discard)
+
+    async def send_file(self, path):
+        """Encrypts a file to the current chat's key and uploads it as NAME.pgp.
+        gpg streams it into a temporary file (Telegram needs the upload size up
+        front), which Telethon then uploads part by part; only ciphertext touches the disk."""
+        chat = self.current_chat
+        if not chat:
+            print_formatted_text(HTML(f"<error>❌ No recipient selected! Use /r to set one.</error>"), style=style)
+            return
+        path = os.path.expanduser(path)
+        if not os.path.isfile(path):
+            print_formatted_text(HTML(f"<error>❌ No such file: {html.escape(path)}</error>"), style=style)
+            return
+        if not chat.fingerprint:
+            print_formatted_text(HTML(f"<error>❌ Not sent: no public key for this chat. Add it to 'contacts' in {KEYS_FILE}.</error>"), style=style)
+            return
+        if not self.pgp.backend.file_transfer:
+            print_formatted_text(HTML(f"<error>❌ {FILE_TRANSFER_BACKEND_ERROR}.</error>"), style=style)
+            return
+        name = os.path.basename(path)
+        size = os.path.getsize(path)
+        loop = asyncio.get_running_loop()
         try:
-            with patch_stdout():
-                status_char = "🔒" if encryption_enabled else "🔓"
-                msg = await session.prompt_async(HTML(f"<b>You {status_char}: </b>"))
+            with tempfile.TemporaryDirectory(prefix='sg_upload_') as tmp_dir:
+                encrypted_path = os.path.join(tmp_dir, name + ENCRYPTED_FILE_SUFFIX)
+                with open(path, 'rb') as f:
+                    reader = ProgressReader(f, size, TransferProgress(f"🔐 Encrypting {name}", loop))
+                    await self.pgp.encrypt_file_async(reader, encrypted_path, chat.fingerprint)
+                await self.transport.send_file(chat.entity, encrypted_path, ENCRYPTED_FILE_CAPTION,
+                                               TransferProgress(f"📤 Uploading {name}", loop))
+            now_str = datetime.now().strftime('%H:%M')
+            RENDERER.add(chat_line('sent', f"{sender_label(now_str, None)} encrypted file: {name} ({format_size(size)})"))
+        except Exception as e:
+            RENDERER.add(chat_line('error', f"❌ File not sent: {e}"))
+
+    async def get_file(self, message_id):
+        """Downloads a file from the current chat into DOWNLOAD_DIR, decrypting NAME.pgp files."""
+        chat = self.current_chat
+        if not chat:
+            print_formatted_text(HTML(f"<error>❌ No active chat.</error>"), style=style)
+            return
+        loop = asyncio.get_running_loop()
+        dest_path = None
+        try:
+            message = await self.transport.get_messages(chat.entity, ids=message_id)
+            if not message or not message.file:
+                raise RuntimeError(f"message {message_id} has no file")
+            # The name is chosen by the sender: never let it point outside DOWNLOAD_DIR
+            name = safe_file_name(message_file_name(message))
+            encrypted = name.endswith(ENCRYPTED_FILE_SUFFIX)
+            if encrypted and not self.pgp.backend.file_transfer: # Before downloading what we cannot decrypt
+                raise RuntimeError(FILE_TRANSFER_BACKEND_ERROR)
+            os.makedirs(DOWNLOAD_DIR, exist_ok=True)
+            dest_path = unique_path(DOWNLOAD_DIR, safe_file_name(name[:-len(ENCRYPTED_FILE_SUFFIX)]) if encrypted else name)
+            download_dir = os.path.realpath(DOWNLOAD_DIR)
+            if os.path.dirname(os.path.realpath(dest_path)) != download_dir:
+                dest_path = None
+                raise RuntimeError(f"refusing to save '{name}' outside {DOWNLOAD_DIR}")
+
+            with tempfile.TemporaryDirectory(prefix='sg_download_') as tmp_dir:
+                download_path = os.path.join(tmp_dir, name)
+                await self.transport.download_media(message, download_path, TransferProgress(f"📥 Downloading {name}", loop))
+                if encrypted:
+                    with open(download_path, 'rb') as f:
+                        reader = ProgressReader(f, os.path.getsize(download_path), TransferProgress(f"🔓 Decrypting {name}", loop))
+                        await self.pgp.decrypt_file_async(reader, dest_path)
+                else:
+                    shutil.move(download_path, dest_path)
+            RENDERER.add(chat_line('system', f"💾 Saved {dest_path}"))
+        except Exception as e:
+            if dest_path and os.path.exists(dest_path):
+                os.remove(dest_path) # Never leave half a decrypted file behind
+            RENDERER.add(chat_line('error', f"❌ Download failed: {e}"))
+
+    def search(self, query):
+        if not self.search_index:
+            print_formatted_text(HTML("<system>🔎 Search is off. Set \"search_index\": true in keys.json to build the index.</system>"), style=style)
+            return
+        start = time.perf_counter()
+        with METRICS.timed('search.query'):
+            results = self.search_index.search(query)
+        elapsed_ms = (time.perf_counter() - start) * 1000
+        print_formatted_text(HTML(f"<system>🔎 {len(results)} match(es) for '{html.escape(query)}' in {elapsed_ms:.1f} ms "
+                                  f"({self.search_index.count()} messages indexed)</system>"), style=style)
+        for entry in reversed(results):
+            when = datetime.fromtimestamp(entry['date']).strftime('%Y-%m-%d %H:%M')
+            sender = "You" if entry['out'] else entry['peer']
+            chat_note = f" → {entry['peer']}" if entry['out'] else ""
+            line = f"[{when}] [{sender}{chat_note}] #{entry['id']}: {entry['text']}"
+            print_formatted_text(HTML(f"<info>{html.escape(line)}</info>"), style=style)
+
+    def print_stats(self):
+        if not METRICS.enabled:
+            print_formatted_text(HTML("<system>📊 Stats are off. Set \"stats\": true in keys.json to collect them.</system>"), style=style)
+            return
+        snapshot = METRICS.snapshot()
+        lines = [f"📊 Stats for the last {snapshot['uptime_s']:.0f} s (p50 / p90 / p99 / max, total time):"]
+        for name, h in snapshot['latency'].items():
+            lines.append(f"  {name:<22} {h['count']:>7}x  {h['p50_ms']:8.2f} / {h['p90_ms']:8.2f} / {h['p99_ms']:8.2f} / {h['max_ms']:8.2f} ms  {h['total_s']:7.2f} s")
+        for name, value in sorted(snapshot['counters'].items()):
+            lines.append(f"  {name:<22} {value:>7}")
+        if len(lines) == 1:
+            lines.append("  Nothing recorded yet.")
+        print_formatted_text(HTML(f"<system>{html.escape(chr(10).join(lines))}</system>"), style=style)
+
+    def panic_wipe(self):
+        open(KEYS_FILE, 'w').close()
+        open(API_CONFIG_FILE, 'w').close() # Wiping API config too
+        open(os.path.join(SCRIPT_DIR, "my_private.asc"), 'w').close()
+        open(os.path.join(SCRIPT_DIR, "friend_public.asc"), 'w').close()
+        self.pgp.shutdown() # Drops the in-memory private key (pgpy) or kills the gpg-agent (gnupg)
+        shutil.rmtree(self.pgp.gpg_home, ignore_errors=True) # Persistent keyring too
+        if self.message_cache:
+            self.message_cache.close()
+        wipe_db_file(CACHE_FILE)
+        if self.search_index:
+            self.search_index.close()
+        wipe_db_file(SEARCH_INDEX_FILE)
+        if os.path.exists(ENTITY_CACHE_FILE): # Who you talk to
+            os.remove(ENTITY_CACHE_FILE)
+        shutil.rmtree(DOWNLOAD_DIR, ignore_errors=True) # Files /getfile saved, decrypted
+        os.system('cls' if os.name == 'nt' else 'clear')
+        sys.exit(0)
+
+    async def run_prompt(self):
+        session = self.prompt_session = PromptSession()
+        print("Use /help to see the list of commands and /exit to quit.")
+    
+        while True:
+            try:
+                with patch_stdout():
+                    status_char = "🔒" if self.encryption_enabled else "🔓"
+                    msg = await session.prompt_async(HTML(f"<b>You {status_char}: </b>"))
+                RENDERER.flush() # Lines still waiting for their frame go above the command's output
 
-            cmd = msg.strip().split()
-            msg_clean = msg.strip()
+                cmd = msg.strip().split()
+                msg_clean = msg.strip()
             
-            if msg_clean in ['/exit', '--exit']:
-                break
+                if msg_clean in ['/exit', '--exit']:
+                    break
             
-            elif msg_clean in ['/help', '/h']:
-                help_text = """
+                elif msg_clean in ['/help', '/h']:
+                    help_text = """
 <system>Available Commands:
 /help, /h           : Show this list of commands.
 /recipient, /r      : Change the recipient (e.g. /r @username).
+/chats              : List open chats and their unread messages.
 /encrypt off, /eof  : Turn OFF encryption (send plain text).
 /encrypt on, /eon   : Turn ON encryption.
-/history [n]        : Show last n messages (max 50, default 20).
-/panic              : Wipe keys, clear screen, and exit immediately.
+/history [n]        : Show last n messages (default 20, no upper limit).
+  --since YYYY-MM-DD: Only messages sent after this date.
+  --offset id       : Only messages older than this message id.
+/sendfile <path>    : Encrypt a file and send it to the current chat.
+/getfile <id>       : Download (and decrypt) the file in message <id> to downloads/.
+/search <terms>     : Search decrypted messages in all chats (term* matches prefixes).
+/events             : Show how many message updates were handled vs. dropped.
+/stats [reset]      : Show call counts and latency of crypto, Telegram and rendering.
+/panic              : Wipe keys and downloads, clear screen, and exit immediately.
 /exit               : Quit the application.</system>
 """
-                print_formatted_text(HTML(help_text), style=style)
+                    print_formatted_text(HTML(help_text), style=style)
 
-            elif msg_clean == '/panic':
-                with patch_stdout():
-                    confirm = await session.prompt_async(HTML("<error>⚠️  CONFIRM PANIC WIPE? (y/n): </error>"))
-                
-                if confirm.lower().strip() == 'y':
-                    try:
-                        open(KEYS_FILE, 'w').close()
-                        open(API_CONFIG_FILE, 'w').close() # Wiping API config too
-                        open(os.path.join(SCRIPT_DIR, "my_private.asc"), 'w').close()
-                        open(os.path.join(SCRIPT_DIR, "friend_public.asc"), 'w').close()
-                        os.system('cls' if os.name == 'nt' else 'clear')
-                        sys.exit(0)
-                    except Exception as e:
-                        print_formatted_text(HTML(f"<error>❌ Panic failed: {e}</error>"), style=style)
-
-            elif msg_clean.startswith('/recipient') or msg_clean.startswith('/r '):
-                new_username = None
-                if len(cmd) > 1:
-                    new_username = cmd[1]
-                else:
+                elif msg_clean == '/panic':
                     with patch_stdout():
-                        new_username = await session.prompt_async(HTML("<system>Enter new username (e.g. @friendlyuser): </system>"))
+                        confirm = await session.prompt_async(HTML("<error>⚠️  CONFIRM PANIC WIPE? (y/n): </error>"))
                 
-                if new_username:
-                    try:
-                        print_formatted_text(HTML(f"<system>🔍 Searching for {new_username}...</system>"), style=style)
-                        new_entity = await client.get_entity(new_username)
-                        current_chat = ChatSession(new_entity) 
-                        print_formatted_text(HTML(f"<system>✅ Switched chat to: {new_entity.first_name}</system>"), style=style)
-                        
+                    if confirm.lower().strip() == 'y':
                         try:
-                            with open(KEYS_FILE, 'r') as f:
-                                config_data = json.load(f)
-                            config_data['target_username'] = new_username
-                            with open(KEYS_FILE, 'w') as f:
-                                json.dump(config_data, f, indent=4) 
-                            print_formatted_text(HTML(f"<system>💾 Updated 'target_username' in {KEYS_FILE}</system>"), style=style)
-                        except Exception as file_err:
-                            print_formatted_text(HTML(f"<error>⚠️ Chat switched, but failed to update JSON: {file_err}</error>"), style=style)
-                    except Exception as e:
-                        print_formatted_text(HTML(f"<error>❌ Could not find user: {e}</error>"), style=style)
-
-            elif msg_clean.startswith('/history'):
-                limit = 20
-                if len(cmd) > 1 and cmd[1].isdigit():
-                    limit = min(int(cmd[1]), 50) 
+                            self.panic_wipe()
+                        except Exception as e:
+                            print_formatted_text(HTML(f"<error>❌ Panic failed: {e}</error>"), style=style)
+
+                elif msg_clean.startswith('/recipient') or msg_clean.startswith('/r '):
+                    new_username = None
+                    if len(cmd) > 1:
+                        new_username = cmd[1]
+                    else:
+                        with patch_stdout():
+                            new_username = await session.prompt_async(HTML("<system>Enter new username (e.g. @friendlyuser): </system>"))
                 
-                if current_chat:
-                    print_formatted_text(HTML(f"<system>⏳ Fetching last {limit} messages...</system>"), style=style)
+                    if new_username:
+                        try:
+                            if normalize_username(new_username) not in self.sessions_by_username:
+                                print_formatted_text(HTML(f"<system>🔍 Searching for {new_username}...</system>"), style=style)
+                            new_chat = await self.open_chat(new_username)
+                            print_formatted_text(HTML(f"<system>✅ Switched chat to: {new_chat.entity.first_name}</system>"), style=style)
+                            self.switch_chat(new_chat)
+
+                            # friends_public_key belongs to target_username: only a chat on that key may take it over
+                            if new_chat.fingerprint == self.pgp.target_fingerprint:
+                                try:
+                                    with open(KEYS_FILE, 'r') as f:
+                                        config_data = json.load(f)
+                                    config_data['target_username'] = new_username
+                                    with open(KEYS_FILE, 'w') as f:
+                                        json.dump(config_data, f, indent=4) 
+                                    self.pgp.default_username = new_username
+                                    print_formatted_text(HTML(f"<system>💾 Updated 'target_username' in {KEYS_FILE}</system>"), style=style)
+                                except Exception as file_err:
+                                    print_formatted_text(HTML(f"<error>⚠️ Chat switched, but failed to update JSON: {file_err}</error>"), style=style)
+                        except Exception as e:
+                            print_formatted_text(HTML(f"<error>❌ Could not find user: {e}</error>"), style=style)
+
+                elif msg_clean.startswith('/history'):
                     try:
-                        history_msgs = await client.get_messages(current_chat.entity, limit=limit)
-                        
-                        print_formatted_text(HTML(f"<system>--- History ({limit}) ---</system>"), style=style)
-                        
-                        for message in reversed(history_msgs):
-                            time_str = message.date.astimezone().strftime('%H:%M')
-                            sender_label = f"[{time_str}] [You]" if message.out else f"[{time_str}] [{current_chat.entity.first_name}]"
-                            content = ""
-
-                            if message.file:
-                                file_name = "file"
-                                # Check if 'document' exists and has 'attributes' before accessing
-                                if hasattr(message.file, 'name') and message.file.name:
-                                    file_name = message.file.name
-                                elif message.document and hasattr(message.document, 'attributes'):
-                                    for attr in message.document.attributes:
-                                        if hasattr(attr, 'file_name') and attr.file_name:
-                                            file_name = attr.file_name
-                                content = f"[{file_name}]"
-                            
-                            elif message.text:
-                                if "BEGIN PGP MESSAGE" in message.text:
-                                    decrypted = pgp.decrypt(message.text)
-                                    if "DECRYPTION_FAILED" in decrypted:
-                                        content = f"<error>🔒 [PGP Error]</error>"
-                                    else:
-                                        content = f"<info>{html.escape(str(decrypted))}</info>"
-                                else:
-                                    content = html.escape(str(message.text))
-                            
-                            elif message.action:
-                                # New check for Calls
-                                if "PhoneCall" in type(message.action).__name__:
-                                    content = "[Call]"
-
-                            if message.out:
-                                print_formatted_text(HTML(f"<sent>{sender_label}: {content}</sent>"), style=style)
+                        limit, since, offset_id = parse_history_args(cmd[1:])
+                    except ValueError as e:
+                        print_formatted_text(HTML(f"<error>❌ {html.escape(str(e))}. Usage: /history [n] [--since YYYY-MM-DD] [--offset id]</error>"), style=style)
+                        continue
+                
+                    if self.current_chat:
+                        scope = f"last {limit}" if since is None else f"{limit or 'all'} since {since:%Y-%m-%d %H:%M}"
+                        print_formatted_text(HTML(f"<system>⏳ Fetching {scope} messages...</system>"), style=style)
+                        print_formatted_text(HTML(f"<system>--- History ---</system>"), style=style)
+                        try:
+                            printed, oldest_id = await stream_history(self.transport, self.pgp, self.message_cache, self.current_chat, limit, since, offset_id, self.search_index)
+                            if oldest_id:
+                                print_formatted_text(HTML(f"<system>--- End of History ({printed}) · older: /history {limit or DEFAULT_HISTORY_LIMIT} --offset {oldest_id} ---</system>"), style=style)
                             else:
-                                print_formatted_text(HTML(f"<user>{sender_label}: {content}</user>"), style=style)
-                                
-                        print_formatted_text(HTML(f"<system>--- End of History ---</system>"), style=style)
-                    except Exception as e:
-                         print_formatted_text(HTML(f"<error>❌ Error fetching history: {e}</error>"), style=style)
+                                print_formatted_text(HTML(f"<system>--- End of History ---</system>"), style=style)
+                        except Exception as e:
+                             print_formatted_text(HTML(f"<error>❌ Error fetching history: {e}</error>"), style=style)
 
-                else:
-                    print_formatted_text(HTML(f"<error>❌ No active chat.</error>"), style=style)
+                    else:
+                        print_formatted_text(HTML(f"<error>❌ No active chat.</error>"), style=style)
 
-            elif msg_clean in ['/encrypt off', '/eof']:
-                encryption_enabled = False
-                print_formatted_text(HTML("<system>🔓 Encryption DISABLED. Sending plain text.</system>"), style=style)
+                elif msg_clean == '/chats':
+                    if not self.sessions:
+                        print_formatted_text(HTML("<system>No open chats. Use /r @username to open one.</system>"), style=style)
+                    for username, chat in self.sessions_by_username.items():
+                        marker = "▶" if chat is self.current_chat else " "
+                        unread = f" ({chat.unread} unread)" if chat.unread else ""
+                        if not chat.fingerprint:
+                            key_note = " ⚠️ no key"
+                        elif chat.fingerprint == self.pgp.target_fingerprint:
+                            key_note = ""
+                        else:
+                            key_note = f" key {chat.fingerprint[-8:]}"
+                        print_formatted_text(HTML(f"<system>{marker} @{html.escape(username)} - {html.escape(chat.entity.first_name or '')}{unread}{key_note}</system>"), style=style)
+
+                elif msg_clean == '/events':
+                    counts = self.event_counts
+                    dropped = counts['received'] - counts['handled']
+                    print_formatted_text(HTML(
+                        f"<system>📊 Message updates: {counts['received']} received, {counts['handled']} handled, "
+                        f"{dropped} dropped ({counts['non_private']} from groups/channels)</system>"), style=style)
+
+                elif msg_clean.startswith('/sendfile'):
+                    path = msg_clean[len('/sendfile'):].strip().strip('"\'')
+                    if not path:
+                        print_formatted_text(HTML("<error>❌ Usage: /sendfile path/to/file</error>"), style=style)
+                        continue
+                    self.start_transfer(self.send_file(path))
+
+                elif msg_clean.startswith('/getfile'):
+                    if len(cmd) != 2 or not cmd[1].isdigit():
+                        print_formatted_text(HTML("<error>❌ Usage: /getfile message_id (shown in /history)</error>"), style=style)
+                        continue
+                    self.start_transfer(self.get_file(int(cmd[1])))
+
+                elif msg_clean.startswith('/search'):
+                    query = msg_clean[len('/search'):].strip()
+                    if not query:
+                        print_formatted_text(HTML("<error>❌ Usage: /search word [more words] [prefix*]</error>"), style=style)
+                        continue
+                    self.search(query)
+
+                elif msg_clean == '/stats':
+                    self.print_stats()
+
+                elif msg_clean == '/stats reset':
+                    METRICS.reset()
+                    print_formatted_text(HTML("<system>📊 Stats reset.</system>"), style=style)
+
+                elif msg_clean in ['/encrypt off', '/eof']:
+                    self.encryption_enabled = False
+                    print_formatted_text(HTML("<system>🔓 Encryption DISABLED. Sending plain text.</system>"), style=style)
             
-            elif msg_clean in ['/encrypt on', '/eon']:
-                encryption_enabled = True
-                print_formatted_text(HTML("<system>🔒 Encryption ENABLED.</system>"), style=style)
-
-            elif msg_clean:
-                if current_chat:
-                    now_str = datetime.now().strftime('%H:%M')
-                    if encryption_enabled:
-                        ciphertext = pgp.encrypt(msg_clean)
-                        await client.send_message(current_chat.entity, ciphertext)
-                        with patch_stdout():
-                            safe_msg = html.escape(msg_clean)
-                            print_formatted_text(HTML(f"<sent>[{now_str}] [You] encrypted: {safe_msg}</sent>"), style=style)
-                    else:
-                        await client.send_message(current_chat.entity, msg_clean)
-                        with patch_stdout():
-                            safe_msg = html.escape(msg_clean)
-                            print_formatted_text(HTML(f"<plain>[{now_str}] [You]: {safe_msg}</plain>"), style=style)
-                else:
-                     print_formatted_text(HTML(f"<error>❌ No recipient selected! Use /r to set one.</error>"), style=style)
+                elif msg_clean in ['/encrypt on', '/eon']:
+                    self.encryption_enabled = True
+                    print_formatted_text(HTML("<system>🔒 Encryption ENABLED.</system>"), style=style)
+
+                elif msg_clean:
+                    self.send_text(msg_clean)
                 
-        except (KeyboardInterrupt, EOFError):
-            break
+            except (KeyboardInterrupt, EOFError):
+                break
+
+# --- Offline Replay ---
+def latency_summary(samples):
+    """Latency summary in milliseconds (n, mean, min, p50/p95/p99, max)."""
+    if not samples:
+        return {"n": 0}
+    ordered = sorted(samples)
+    def percentile(p):
+        return ordered[min(len(ordered) - 1, int(round(p / 100 * (len(ordered) - 1))))] * 1000
+    return {
+        "n": len(ordered),
+        "mean_ms": sum(ordered) / len(ordered) * 1000,
+        "min_ms": ordered[0] * 1000,
+        "p50_ms": percentile(50),
+        "p95_ms": percentile(95),
+        "p99_ms": percentile(99),
+        "max_ms": ordered[-1] * 1000,
+    }
+
+async def run_replay(pgp, records, rate=None, quiet=False):
+    """Pushes a recorded/synthetic stream through SilentGramApp on a ReplayTransport.
+    Pacing: `rate` messages per second if given, else each record's "at" offset,
+    else as fast as possible. Returns a report dict: latency is receipt ->
+    printed line for the current chat, buffered_latency receipt -> line kept for
+    a background chat; queue depth is handler tasks still running plus lines
+    waiting in the Renderer."""
+    transport = ReplayTransport()
+    app = SilentGramApp(pgp, transport)
+
+    # Every chat in the stream gets a session, so background buffering is exercised too
+    for record in records:
+        if 'send' not in record:
+            # Stream chats are stand-ins: all of them use friends_public_key
+            chat = await app.open_chat(record.get('chat', '@replay'), pgp.target_fingerprint)
+            if app.current_chat is None:
+                app.switch_chat(chat)
+
+    latencies = []
+    buffered_latencies = []
+    in_flight = set()
+    depth_samples = [] # (handler tasks, lines waiting to be rendered)
+    app.on_rendered = lambda event: latencies.append(time.perf_counter() - event.received_at)
+    app.on_buffered = lambda event: buffered_latencies.append(time.perf_counter() - event.received_at)
+
+    async def deliver(record):
+        if 'send' in record:
+            app.send_text(record['send'])
+        else:
+            await transport.deliver(record)
+
+    output = DummyOutput() if quiet else None
+    with create_app_session(output=output) if quiet else patch_stdout():
+        start = time.perf_counter()
+        for i, record in enumerate(records):
+            if rate:
+                due = i / rate
+            else:
+                due = float(record.get('at', 0))
+            delay = start + due - time.perf_counter()
+            await asyncio.sleep(max(delay, 0))
+
+            # Like Telethon, every update is handled in its own task
+            task = asyncio.ensure_future(deliver(record))
+            in_flight.add(task)
+            task.add_done_callback(in_flight.discard)
+            depth_samples.append((len(in_flight), len(RENDERER.lines)))
+        await asyncio.gather(*list(in_flight))
+        await app.send_queue.drain()
+        RENDERER.flush()
+        duration = time.perf_counter() - start
+
+    counts = app.event_counts
+    return {
+        "messages": sum(1 for r in records if 'send' not in r),
+        "sends": sum(1 for r in records if 'send' in r),
+        "captured_sends": len(transport.sent),
+        "handled": counts['handled'],
+        "dropped": counts['received'] - counts['handled'],
+        "duration_s": duration,
+        "throughput_msgs_per_s": len(records) / duration if duration else None,
+        "latency": latency_summary(latencies),
+        "buffered_latency": latency_summary(buffered_latencies),
+        "queue_depth": {
+            "max": max((tasks + lines for tasks, lines in depth_samples), default=0),
+            "mean": sum(tasks + lines for tasks, lines in depth_samples) / len(depth_samples) if depth_samples else 0,
+            "max_handlers": max((tasks for tasks, _ in depth_samples), default=0),
+            "max_render": max((lines for _, lines in depth_samples), default=0),
+        },
+        "stats": METRICS.snapshot(),
+        "sent": transport.sent,
+    }
+
+# --- Entry Point ---
+def peek_target_username():
+    """target_username from keys.json without loading any keys (None if unset or unreadable)."""
+    try:
+        with open(KEYS_FILE, 'r') as f:
+            return json.load(f).get('target_username') or None
+    except (OSError, ValueError, AttributeError):
+        return None
+
+class StartupProfile:
+    """Wall-clock start-up phases for --profile-startup. Phases that ran
+    concurrently show overlapping offsets."""
+
+    def __init__(self, enabled):
+        self.enabled = enabled
+        self.phases = [] # (name, start, end)
+
+    def add(self, name, start, end):
+        if self.enabled:
+            self.phases.append((name, start, end))
+
+    @contextlib.contextmanager
+    def phase(self, name):
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.add(name, start, time.perf_counter())
+
+    def report(self):
+        if not self.enabled:
+            return
+        lines = ["⏱️  Start-up profile (offset from first import → duration):"]
+        for name, start, end in sorted(self.phases, key=lambda phase: phase[1]):
+            lines.append(f"  {name:<20} +{(start - MODULE_LOAD_STARTED) * 1000:7.1f} ms  {(end - start) * 1000:7.1f} ms")
+        lines.append(f"  {'ready':<20} +{(time.perf_counter() - MODULE_LOAD_STARTED) * 1000:7.1f} ms")
+        print_formatted_text(HTML(f"<system>{html.escape(chr(10).join(lines))}</system>"), style=style)
+
+async def main(args):
+    main_started = time.perf_counter()
+    if args.replay:
+        pgp = PGPEngine()
+        METRICS.enabled = pgp.stats_enabled
+        RENDERER.interval = pgp.render_interval_ms / 1000
+        try:
+            report = await run_replay(pgp, ReplayTransport.load(args.replay), args.rate, args.quiet)
+        finally:
+            pgp.shutdown()
+        latency = report['latency']
+        print_formatted_text(HTML(
+            f"<system>📼 Replayed {report['messages']} messages + {report['sends']} sends in {report['duration_s']:.2f} s "
+            f"({report['throughput_msgs_per_s']:.0f}/s), {report['captured_sends']} send_message calls captured</system>"), style=style)
+        if latency['n']:
+            print_formatted_text(HTML(
+                f"<system>   receipt → rendered: p50 {latency['p50_ms']:.2f} ms, p95 {latency['p95_ms']:.2f} ms, "
+                f"p99 {latency['p99_ms']:.2f} ms, max {latency['max_ms']:.2f} ms; "
+                f"queue depth max {report['queue_depth']['max']}</system>"), style=style)
+        buffered = report['buffered_latency']
+        if buffered['n']:
+            print_formatted_text(HTML(
+                f"<system>   receipt → buffered (background chats): {buffered['n']} lines, p50 {buffered['p50_ms']:.2f} ms, "
+                f"p99 {buffered['p99_ms']:.2f} ms</system>"), style=style)
+        if args.report:
+            with open(args.report, 'w') as f:
+                json.dump(report, f, indent=2)
+        return
+
+    profile = StartupProfile(args.profile_startup)
+    profile.add('imports', MODULE_LOAD_STARTED, main_started)
+
+    # 1. Load API Keys first
+    with profile.phase('api credentials'):
+        api_id, api_hash = get_api_credentials()
+
+    # 2. Key import (gpg subprocesses or PGPy) runs in a thread while Telegram
+    # connects. Only on warm starts: a first login asks for the phone number and
+    # code, which must not be interleaved with key-loading output.
+    loop = asyncio.get_running_loop()
+
+    def load_engine():
+        with profile.phase('keys (PGPEngine)'):
+            return PGPEngine()
+
+    async def connect(prefetch_username):
+        with profile.phase('import telethon'):
+            transport = TelegramTransport(api_id, api_hash)
+        with profile.phase('telegram connect'):
+            await transport.start()
+        if prefetch_username:
+            with profile.phase('resolve recipient'):
+                try:
+                    await transport.get_entity(prefetch_username)
+                except Exception:
+                    pass # Reported properly when the chat is opened below
+        return transport
+
+    if os.path.exists(SESSION_FILE + '.session'):
+        pgp, transport = await asyncio.gather(loop.run_in_executor(None, load_engine), connect(peek_target_username()))
+    else:
+        pgp = load_engine()
+        transport = await connect(None)
+
+    METRICS.enabled = pgp.stats_enabled
+    RENDERER.interval = pgp.render_interval_ms / 1000
+    stats_task = None
+    if pgp.stats_enabled and pgp.stats_file:
+        stats_task = asyncio.ensure_future(dump_stats_periodically(pgp.stats_file, pgp.stats_interval))
+    message_cache = None
+    if pgp.message_cache_enabled:
+        with profile.phase('message cache'):
+            message_cache = MessageCache(CACHE_FILE, pgp.storage_secret(), pgp.message_cache_max_entries)
+    search_index = None
+    if pgp.search_index_enabled:
+        with profile.phase('search index'):
+            search_index = SearchIndex(SEARCH_INDEX_FILE, pgp.storage_secret())
+
+    # --- SETUP PHASE ---
+    app = SilentGramApp(pgp, transport, message_cache, search_index)
+    target_user = pgp.default_username
+    
+    if not target_user:
+        print_formatted_text(HTML("<system>⚠️ No 'target_username' found in keys.json.</system>"), style=style)
+        
+        while not target_user:
+             print("Please enter the recipient username (e.g. @friend): ", end="", flush=True)
+             target_user = sys.stdin.readline().strip()
+             
+             if not target_user:
+                 print("Username cannot be empty.")
+
+        try:
+            with open(KEYS_FILE, 'r') as f:
+                config_data = json.load(f)
+            config_data['target_username'] = target_user
+            with open(KEYS_FILE, 'w') as f:
+                json.dump(config_data, f, indent=4)
+            pgp.default_username = target_user # friends_public_key is theirs from now on
+            print_formatted_text(HTML(f"<system>💾 Saved '{target_user}' to {KEYS_FILE}</system>"), style=style)
+        except Exception as e:
+             print_formatted_text(HTML(f"<error>⚠️ Failed to save recipient to JSON: {e}</error>"), style=style)
+
+    try:
+        with profile.phase('open chat'):
+            initial_chat = await app.open_chat(target_user)
+        print_formatted_text(HTML(f"<system>--- Chatting with {initial_chat.entity.first_name} ---</system>"), style=style)
+        app.switch_chat(initial_chat)
+    except Exception as e:
+        print_formatted_text(HTML(f"<error>❌ Connection error: Could not find user '{target_user}'. Error: {e}</error>"), style=style)
+        print_formatted_text(HTML(f"<error>Please check the username and restart, or use /recipient to switch.</error>"), style=style)
+    profile.report()
+
+    backfill_task = None
+    if search_index:
+        backfill_task = asyncio.ensure_future(backfill_search_index(app, pgp.search_backfill_delay))
+
+    # --- CHAT PHASE ---
+    await app.run_prompt()
+
+    if backfill_task:
+        backfill_task.cancel()
+
+    if app.transfers:
+        for task in app.transfers:
+            task.cancel()
+        print_formatted_text(HTML(f"<error>⚠️ {len(app.transfers)} file transfer(s) cancelled.</error>"), style=style)
+
+    if len(app.send_queue):
+        print_formatted_text(HTML(f"<system>⏳ Sending {len(app.send_queue)} queued message(s)...</system>"), style=style)
+        unsent = await app.send_queue.drain()
+        RENDERER.flush() # Delivery lines of the last queued messages
+        if unsent:
+            print_formatted_text(HTML(f"<error>❌ {unsent} message(s) were not sent.</error>"), style=style)
+    if stats_task:
+        stats_task.cancel()
+        try:
+            METRICS.dump(pgp.stats_file)
+        except OSError:
+            pass
+    await transport.disconnect()
+    pgp.shutdown()
+    if message_cache:
+        message_cache.close()
+    if search_index:
+        search_index.close()
 
-    await client.disconnect()
+def parse_args():
+    parser = argparse.ArgumentParser(description="SilentGram: PGP-encrypted Telegram in your terminal")
+    parser.add_argument('--replay', metavar='STREAM.jsonl', help="offline load test: replay a message stream instead of connecting to Telegram")
+    parser.add_argument('--rate', type=float, help="replay speed in messages/second (default: the stream's 'at' times)")
+    parser.add_argument('--quiet', action='store_true', help="replay without drawing to the terminal")
+    parser.add_argument('--report', metavar='FILE', help="write the replay report (JSON) here")
+    parser.add_argument('--profile-startup', action='store_true', help="print how long each start-up phase took")
+    return parser.parse_args()
 
 if __name__ == '__main__':
-    asyncio.run(main())
+    asyncio.run(main(parse_args()))
@@ -0,0 +1,426 @@
+'''
+SilentGram Benchmarks
+=====================
+Offline benchmarks for SilentGram's hot paths. No Telegram account is needed:
+throwaway keys are generated in a temporary GPG home.
+
+Benches:
+  startup       PGPEngine.__init__ (cold keyring; warm too with --persistent)
+  crypto        encrypt/decrypt latency and throughput per message size
+  burst         encrypt_async+gather and decrypt_many throughput per burst size
+  decrypt_many  serial loop vs decrypt_async+gather vs decrypt_many
+  render        one chat line: html.escape + print_formatted_text(HTML(...)) vs.
+                fragments through the Renderer; and a burst of lines above a
+                live prompt, printed one by one vs. in one batch
+  wire          armor vs. compact wire format: characters, Telegram messages
+                and bytes on the wire per message size
+  replay        a message stream through the real handler on the offline
+                ReplayTransport: receipt -> rendered latency and queue depth
+
+Results are written as JSON to stdout (or --output FILE); the human-readable
+summary goes to stderr, so `python silentgram_bench.py > results.json` works.
+
+Usage:
+    python silentgram_bench.py [--backend gnupg|pgpy] [--agent] [--only crypto,render]
+'''
+
+import io
+import os
+import gzip
+import sys
+import json
+import html
+import time
+import random
+import string
+import asyncio
+import argparse
+import platform
+import tempfile
+import subprocess
+from datetime import datetime, timezone
+
+import gnupg
+from prompt_toolkit import PromptSession, print_formatted_text, HTML
+from prompt_toolkit.application import run_in_terminal
+from prompt_toolkit.application.current import create_app_session
+from prompt_toolkit.input import create_pipe_input
+from prompt_toolkit.data_structures import Size
+from prompt_toolkit.output import DummyOutput
+from prompt_toolkit.output.vt100 import Vt100_Output
+
+import silentgram
+
+BENCH_PASSPHRASE = 'silentgram-bench'
+ALL_BENCHES = ['startup', 'crypto', 'burst', 'decrypt_many', 'wire', 'render', 'replay']
+
+def log(text=""):
+    print(text, file=sys.stderr)
+
+summarize = silentgram.latency_summary
+
+def random_text(size):
+    alphabet = string.ascii_letters + string.digits + ' .,!?<>&'
+    return ''.join(random.choice(alphabet) for _ in range(size))
+
+def create_throwaway_keys(work_dir):
+    """Generates a passphrase-protected key pair in a scratch GPG home and exports
+    it as .asc files. Returns (private key path, public key path)."""
+    keygen_home = os.path.join(work_dir, 'keygen')
+    os.makedirs(keygen_home, mode=0o700)
+    gpg = gnupg.GPG(gnupghome=keygen_home, gpgbinary=silentgram.find_gpg_binary())
+    key_input = gpg.gen_key_input(
+        name_real='SilentGram Bench',
+        name_email='bench@silentgram.invalid',
+        key_type='RSA', key_length=2048, key_usage='sign',
+        subkey_type='RSA', subkey_length=2048, subkey_usage='encrypt',
+        passphrase=BENCH_PASSPHRASE,
+    )
+    key = gpg.gen_key(key_input)
+    if not key.fingerprint:
+        log(f"❌ Key generation failed: {key.stderr}")
+        sys.exit(1)
+
+    priv_path = os.path.join(work_dir, 'bench_private.asc')
+    pub_path = os.path.join(work_dir, 'bench_public.asc')
+    with open(priv_path, 'w') as f:
+        f.write(gpg.export_keys(key.fingerprint, secret=True, passphrase=BENCH_PASSPHRASE))
+    with open(pub_path, 'w') as f:
+        f.write(gpg.export_keys(key.fingerprint))
+    subprocess.run([silentgram.find_gnupg_tool('gpgconf'), '--homedir', keygen_home, '--kill', 'gpg-agent'], capture_output=True)
+    return priv_path, pub_path
+
+def write_keys_file(work_dir, priv_path, pub_path, **options):
+    keys_file = os.path.join(work_dir, 'keys.json')
+    config = {
+        "my_private_key": priv_path,
+        "my_private_key_passphrase": BENCH_PASSPHRASE,
+        "friends_public_key": pub_path,
+        "target_username": "",
+    }
+    config.update(options)
+    with open(keys_file, 'w') as f:
+        json.dump(config, f, indent=4)
+    return keys_file
+
+def engine_options(args):
+    options = {"crypto_backend": args.backend}
+    if args.agent:
+        options["gpg_agent"] = True
+        if args.agent_s2k_count:
+            options["agent_s2k_count"] = args.agent_s2k_count
+    return options
+
+def make_engine(keys_file, gpg_home):
+    # PGPEngine reports progress through prompt_toolkit; keep it out of the results
+    with create_app_session(output=DummyOutput()):
+        return silentgram.PGPEngine(keys_file=keys_file, gpg_home=gpg_home)
+
+# --- Benches ---
+def bench_startup(args, work_dir, priv_path, pub_path):
+    results = {}
+    modes = [('cold', False)] + ([('warm', True)] if args.persistent and args.backend == 'gnupg' else [])
+    for mode, persistent in modes:
+        keys_file = write_keys_file(work_dir, priv_path, pub_path, persistent_keyring=persistent, **engine_options(args))
+        gpg_home = os.path.join(work_dir, f'startup_{mode}')
+        if persistent:
+            make_engine(keys_file, gpg_home).shutdown() # Populate the keyring and manifest first
+        samples = []
+        for i in range(args.startup_runs):
+            home = gpg_home if persistent else f"{gpg_home}_{i}"
+            start = time.perf_counter()
+            pgp = make_engine(keys_file, home)
+            samples.append(time.perf_counter() - start)
+            pgp.shutdown()
+        results[mode] = summarize(samples)
+        log(f"startup ({mode}): p50 {results[mode]['p50_ms']:.1f} ms, max {results[mode]['max_ms']:.1f} ms")
+    return results
+
+def reassemble(parts):
+    if len(parts) == 1:
+        return parts[0]
+    assembler = silentgram.CompactAssembler()
+    for i, part in enumerate(parts):
+        assembled = assembler.add(0, i, silentgram.parse_compact(part))
+    return assembled[0]
+
+def bench_wire(args, pgp):
+    # Chat-like text (repeated words) compresses the way real messages do
+    words = [random_text(random.randint(2, 9)).strip() or 'x' for _ in range(300)]
+    results = []
+    saved_format = pgp.wire_format
+    try:
+        for size in [int(s) for s in args.sizes.split(',') if s]:
+            text = ' '.join(random.choice(words) for _ in range(size))[:size]
+            entry = {"text_chars": size}
+            for wire_format in ('armor', 'compact'):
+                pgp.wire_format = wire_format
+                start = time.perf_counter()
+                parts = pgp.encrypt_for_wire(text)
+                encrypt_s = time.perf_counter() - start
+                assert pgp.decrypt(reassemble(parts)) == text, f"{wire_format} round trip failed"
+                chars = sum(len(p) for p in parts)
+                utf8 = [p.encode('utf-8') for p in parts]
+                entry[wire_format] = {
+                    "chars": chars,
+                    # Armor is one message; over 4096 characters Telegram rejects it
+                    "telegram_messages": len(parts) if wire_format == 'compact' else -(-chars // silentgram.TELEGRAM_MESSAGE_LIMIT),
+                    "utf8_bytes": sum(len(b) for b in utf8),
+                    # Telethon gzips requests when that is smaller, so this is closer to what is sent
+                    "gzip_bytes": sum(min(len(b), len(gzip.compress(b))) for b in utf8),
+                    "encrypt_ms": encrypt_s * 1000,
+                }
+            results.append(entry)
+            log(f"wire {size:>6} chars: armor {entry['armor']['chars']} chars/{entry['armor']['telegram_messages']} msg, "
+                f"compact {entry['compact']['chars']} chars/{entry['compact']['telegram_messages']} msg; "
+                f"gzip bytes {entry['armor']['gzip_bytes']} vs {entry['compact']['gzip_bytes']}")
+    finally:
+        pgp.wire_format = saved_format
+    return results
+
+def bench_crypto(args, pgp):
+    results = []
+    for size in [int(s) for s in args.sizes.split(',') if s]:
+        message = random_text(size)
+        encrypt_samples, decrypt_samples = [], []
+        block = None
+        for _ in range(args.iterations):
+            start = time.perf_counter()
+            block = pgp.encrypt(message)
+            encrypt_samples.append(time.perf_counter() - start)
+        for _ in range(args.iterations):
+            start = time.perf_counter()
+            plaintext = pgp.decrypt(block)
+            decrypt_samples.append(time.perf_counter() - start)
+        assert plaintext == message, "round trip mismatch"
+        entry = {
+            "size_bytes": size,
+            "armored_bytes": len(block),
+            "encrypt": summarize(encrypt_samples),
+            "decrypt": summarize(decrypt_samples),
+            "encrypt_bytes_per_s": size * len(encrypt_samples) / sum(encrypt_samples),
+            "decrypt_bytes_per_s": size * len(decrypt_samples) / sum(decrypt_samples),
+        }
+        results.append(entry)
+        log(f"crypto {size:>7} B: encrypt p50 {entry['encrypt']['p50_ms']:8.2f} ms, decrypt p50 {entry['decrypt']['p50_ms']:8.2f} ms")
+    return results
+
+async def bench_burst(args, pgp):
+    results = []
+    for burst in [int(b) for b in args.bursts.split(',') if b]:
+        messages = [random_text(args.burst_size) for _ in range(burst)]
+
+        start = time.perf_counter()
+        blocks = await asyncio.gather(*(pgp.encrypt_async(m) for m in messages))
+        encrypt_s = time.perf_counter() - start
+
+        start = time.perf_counter()
+        plaintexts = await pgp.decrypt_many(blocks)
+        decrypt_s = time.perf_counter() - start
+
+        assert plaintexts == messages, "round trip mismatch"
+        entry = {
+            "burst": burst,
+            "message_bytes": args.burst_size,
+            "encrypt_s": encrypt_s,
+            "decrypt_s": decrypt_s,
+            "encrypt_msgs_per_s": burst / encrypt_s,
+            "decrypt_msgs_per_s": burst / decrypt_s,
+        }
+        results.append(entry)
+        log(f"burst {burst:>5}: encrypt {entry['encrypt_msgs_per_s']:8.1f} msg/s, decrypt {entry['decrypt_msgs_per_s']:8.1f} msg/s")
+    return results
+
+async def bench_decrypt_many(args, pgp):
+    results = []
+    for count in [int(c) for c in args.counts.split(',') if c]:
+        blocks = [pgp.encrypt(f"benchmark message #{i}") for i in range(count)]
+
+        start = time.perf_counter()
+        serial = [pgp.decrypt(block) for block in blocks]
+        serial_s = time.perf_counter() - start
+
+        start = time.perf_counter()
+        gathered = await asyncio.gather(*(pgp.decrypt_async(block) for block in blocks))
+        gathered_s = time.perf_counter() - start
+
+        start = time.perf_counter()
+        batched = await pgp.decrypt_many(blocks)
+        batched_s = time.perf_counter() - start
+
+        assert serial == gathered == batched, "decrypt paths disagree"
+        results.append({
+            "count": count,
+            "serial_s": serial_s,
+            "decrypt_async_gather_s": gathered_s,
+            "decrypt_many_s": batched_s,
+        })
+        log(f"decrypt_many {count:>5}: serial {serial_s:.3f} s, gather {gathered_s:.3f} s, many {batched_s:.3f} s")
+    return results
+
+async def render_burst(output, lines, batched):
+    """Seconds to print `lines` above a running prompt, redraws included."""
+    with create_pipe_input() as pipe_input, create_app_session(input=pipe_input, output=output):
+        session = PromptSession()
+        prompt = asyncio.ensure_future(session.prompt_async("You 🔒: "))
+        await asyncio.sleep(0.05) # Let the prompt draw itself
+        start = time.perf_counter()
+        for text in lines:
+            if batched:
+                silentgram.RENDERER.add(silentgram.chat_line('user', f"{silentgram.sender_label('12:00', 'Bench')} decrypted: {text}"))
+            else:
+                print_formatted_text(HTML(f"<user>[12:00] [Bench] decrypted: {html.escape(text)}</user>"), style=silentgram.style)
+        silentgram.RENDERER.flush()
+        await asyncio.sleep(0) # print_formatted_text() schedules its output with call_soon_threadsafe
+        await run_in_terminal(lambda: None) # Runs after every print queued before it
+        elapsed = time.perf_counter() - start
+        pipe_input.send_text('\r')
+        await prompt
+    return elapsed
+
+async def bench_render(args):
+    # A real VT100 writer (escape sequences and all) into memory, so the number is
+    # the formatting cost without the terminal's own drawing time.
+    output = Vt100_Output(io.StringIO(), lambda: Size(rows=40, columns=120))
+    results = []
+    for size in [int(s) for s in args.render_sizes.split(',') if s]:
+        text = random_text(size)
+        html_samples = []
+        fragment_samples = []
+        with create_app_session(output=output):
+            for _ in range(args.render_lines):
+                start = time.perf_counter()
+                safe_decrypted = html.escape(text)
+                print_formatted_text(HTML(f"<user>[12:00] [Bench] decrypted: {safe_decrypted}</user>"), style=silentgram.style, output=output)
+                html_samples.append(time.perf_counter() - start)
+
+                start = time.perf_counter()
+                silentgram.RENDERER.add(silentgram.chat_line('user', f"{silentgram.sender_label('12:00', 'Bench')} decrypted: {text}"))
+                silentgram.RENDERER.flush()
+                fragment_samples.append(time.perf_counter() - start)
+                output.stdout.seek(0)
+                output.stdout.truncate()
+
+        burst = [random_text(size) for _ in range(args.render_burst)]
+        per_line_s = await render_burst(output, burst, batched=False)
+        batched_s = await render_burst(output, burst, batched=True)
+        output.stdout.seek(0)
+        output.stdout.truncate()
+
+        entry = {
+            "text_bytes": size,
+            "line": summarize(html_samples),
+            "lines_per_s": len(html_samples) / sum(html_samples),
+            "renderer_line": summarize(fragment_samples),
+            "renderer_lines_per_s": len(fragment_samples) / sum(fragment_samples),
+            "burst_lines": args.render_burst,
+            "burst_per_line_s": per_line_s,
+            "burst_batched_s": batched_s,
+        }
+        results.append(entry)
+        log(f"render {size:>6} B: p50 {entry['line']['p50_ms']:.3f} ms/line (HTML), {entry['renderer_line']['p50_ms']:.3f} ms/line (Renderer); "
+            f"burst of {args.render_burst} at the prompt {per_line_s * 1000:.1f} ms one by one, {batched_s * 1000:.1f} ms batched")
+    return results
+
+def synthetic_stream(pgp, count, chats, pgp_share):
+    """Incoming messages spread over `chats` chats, `pgp_share` of them PGP blocks."""
+    # Encrypting is not what is measured here, so a handful of blocks are reused
+    blocks = [pgp.encrypt(random_text(size)) for size in (32, 128, 512, 1024)]
+    records = []
+    for i in range(count):
+        text = blocks[i % len(blocks)] if random.random() < pgp_share else random_text(64)
+        records.append({"chat": f"@bench{i % chats}", "text": text})
+    return records
+
+async def bench_replay(args, pgp):
+    if args.replay_file:
+        records = silentgram.ReplayTransport.load(args.replay_file)
+        log(f"replay: {len(records)} records from {args.replay_file}")
+    else:
+        records = synthetic_stream(pgp, args.replay_messages, args.replay_chats, args.replay_pgp_share)
+    results = []
+    for rate in [float(r) for r in args.replay_rates.split(',') if r]:
+        report = await silentgram.run_replay(pgp, records, rate=rate or None, quiet=True)
+        report.pop('sent')
+        report['rate'] = rate or None
+        results.append(report)
+        latency = report['latency']
+        log(f"replay {rate or 'max':>6}/s: p50 {latency['p50_ms']:.2f} ms, p99 {latency['p99_ms']:.2f} ms "
+            f"({latency['n']} rendered, {report['buffered_latency']['n']} buffered), "
+            f"queue depth max {report['queue_depth']['max']} (render {report['queue_depth']['max_render']})")
+    return results
+
+async def run(args):
+    benches = ALL_BENCHES if args.only == 'all' else args.only.split(',')
+    report = {
+        "silentgram_version": silentgram.__version__,
+        "timestamp": datetime.now(timezone.utc).isoformat(),
+        "python": platform.python_version(),
+        "platform": platform.platform(),
+        "cpu_count": os.cpu_count(),
+        "backend": args.backend,
+        "gpg_agent": args.agent,
+        "agent_s2k_count": args.agent_s2k_count,
+    }
+
+    with tempfile.TemporaryDirectory(prefix='sg_bench_') as work_dir:
+        priv_path, pub_path = create_throwaway_keys(work_dir)
+        if 'startup' in benches:
+            report['startup'] = bench_startup(args, work_dir, priv_path, pub_path)
+
+        if any(b in benches for b in ('crypto', 'burst', 'decrypt_many', 'wire', 'replay')):
+            keys_file = write_keys_file(work_dir, priv_path, pub_path, **engine_options(args))
+            pgp = make_engine(keys_file, os.path.join(work_dir, 'gpg_home'))
+            report['crypto_workers'] = pgp.crypto_workers
+            if pgp.backend.name == 'gnupg':
+                report['gpg_version'] = ".".join(str(v) for v in pgp.backend.gpg.version)
+            try:
+                if 'crypto' in benches:
+                    report['crypto'] = bench_crypto(args, pgp)
+                if 'burst' in benches:
+                    report['burst'] = await bench_burst(args, pgp)
+                if 'decrypt_many' in benches:
+                    report['decrypt_many'] = await bench_decrypt_many(args, pgp)
+                if 'wire' in benches:
+                    report['wire'] = bench_wire(args, pgp)
+                if 'replay' in benches:
+                    report['replay'] = await bench_replay(args, pgp)
+            finally:
+                pgp.shutdown()
+
+    if 'render' in benches:
+        report['render'] = await bench_render(args)
+
+    if args.output:
+        with open(args.output, 'w') as f:
+            json.dump(report, f, indent=2)
+        log(f"\nResults written to {args.output}")
+    else:
+        print(json.dumps(report, indent=2))
+
+def main():
+    parser = argparse.ArgumentParser(description="Offline SilentGram benchmarks (JSON results)")
+    parser.add_argument('--backend', choices=['gnupg', 'pgpy'], default='gnupg')
+    parser.add_argument('--agent', action='store_true', help="use the gpg-agent session (gnupg backend)")
+    parser.add_argument('--agent-s2k-count', type=int, help="agent_s2k_count to use with --agent (default: gpg-agent's own)")
+    parser.add_argument('--persistent', action='store_true', help="also measure a warm start with the persistent keyring")
+    parser.add_argument('--only', default='all', help=f"comma-separated benches: {','.join(ALL_BENCHES)}")
+    parser.add_argument('--output', help="write JSON here instead of stdout")
+    parser.add_argument('--iterations', type=int, default=20, help="samples per message size (crypto)")
+    parser.add_argument('--sizes', default='16,256,1024,4096,65536', help="message sizes in bytes (crypto)")
+    parser.add_argument('--bursts', default='1,10,100', help="burst sizes (burst)")
+    parser.add_argument('--burst-size', type=int, default=256, help="message size in a burst, bytes")
+    parser.add_argument('--counts', default='10,100,1000', help="batch sizes (decrypt_many)")
+    parser.add_argument('--startup-runs', type=int, default=5)
+    parser.add_argument('--render-lines', type=int, default=500, help="lines per size (render)")
+    parser.add_argument('--render-sizes', default='32,256,2048')
+    parser.add_argument('--render-burst', type=int, default=200, help="lines printed above a live prompt at once (render)")
+    parser.add_argument('--replay-file', help="replay this JSONL stream instead of a synthetic one (replay)")
+    parser.add_argument('--replay-messages', type=int, default=500, help="synthetic stream length (replay)")
+    parser.add_argument('--replay-chats', type=int, default=3)
+    parser.add_argument('--replay-pgp-share', type=float, default=0.5, help="fraction of PGP messages (replay)")
+    parser.add_argument('--replay-rates', default='50,200,0', help="messages/second, 0 = as fast as possible (replay)")
+    asyncio.run(run(parser.parse_args()))
+
+if __name__ == '__main__':
+    main()